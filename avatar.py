@@ -17,23 +17,211 @@
 # <http://www.gnu.org/licenses/>.
 
 from random import Random
-from core import WorldView
+from core import WorldView, Rect, overlapping_pairs, BOUNDING_SLACK
 from unicorn import UnicornData, Unicorn
 from background import get_background, BackgroundData
-from math import sqrt
-from graphics import SquareImage
+from math import sqrt, floor, ceil
+from graphics import (backends, warm_span_tables, reduce_rows, write_apng, write_gif, color_counts,
+                      gif_palette, index_rows)
+from itertools import chain
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import struct
 
 
 class BadHashString(Exception):
     pass
 
 
-def create_avatar(size, hash_val, with_background = True):
-    """Returns a unicorn image with *twice* the given size (i.e. with size=128,
-       you'll get a 256x256 image) -- it's aliased, so you'll want to run it
-       through a resizing filter to have an antialiased image of your actual
-       desired size."""
+# Bump this whenever the same arguments to create_avatar() start giving a
+# different image (e.g. when the randomizing changes); it's part of every
+# avatar_key(), so cached images from older versions are never used.
+# Version 5 is the randomizing; 6 had capsules for all straight bones and
+# is skipped; 7 draws the pupils in z-buffer mode.
+ALGORITHM_VERSION = 7
+
+
+def avatar_key(size, hash_val, with_background = True, format = "bmp", png_level = 6, downsample = False,
+               zbuffer = False):
+    """The cache key of the image create_avatar() returns for these arguments:
+       a 20 byte digest. The backend doesn't matter, they all draw the same."""
+    if format != "png":
+        png_level = None
+    parameters = (ALGORITHM_VERSION, size, hash_val, bool(with_background), format, png_level, bool(downsample))
+    if zbuffer:
+        # only added when set, so the other keys stay what they were
+        parameters += ("zbuffer",)
+    return hashlib.sha1(repr(parameters).encode("utf-8")).digest()
+
+
+def _plain(value):
+    """Turns tuples into lists (recursively), so a value looks the same
+       before and after a round trip through JSON."""
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((key, _plain(v)) for key, v in value.items())
+    return value
+
+
+def _pack(value, out):
+    if isinstance(value, bool) or value is None:
+        raise ValueError("Can't encode %r" % (value,))
+    if isinstance(value, int):
+        # most parameters are small integers
+        if -128 <= value < 128:
+            out.append(b"b" + struct.pack(">b", value))
+        elif -2**31 <= value < 2**31:
+            out.append(b"i" + struct.pack(">i", value))
+        else:
+            out.append(b"q" + struct.pack(">q", value))
+    elif isinstance(value, float):
+        out.append(b"d" + struct.pack(">d", value))
+    elif isinstance(value, str):
+        encoded = value.encode("utf-8")
+        out.append(b"s" + struct.pack(">H", len(encoded)) + encoded)
+    elif isinstance(value, list):
+        out.append(b"l" + struct.pack(">H", len(value)))
+        for v in value:
+            _pack(v, out)
+    elif isinstance(value, dict):
+        out.append(b"m" + struct.pack(">H", len(value)))
+        for key in sorted(value):
+            _pack(key, out)
+            _pack(value[key], out)
+    else:
+        raise ValueError("Can't encode %r" % (value,))
+
+
+_numbers = {b"b": ">b", b"i": ">i", b"q": ">q", b"d": ">d"}
+
+
+def _unpack(data, pos):
+    """Returns the value starting at data[pos] and the position after it."""
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag in _numbers:
+        format = _numbers[tag]
+        return struct.unpack_from(format, data, pos)[0], pos + struct.calcsize(format)
+    length, = struct.unpack_from(">H", data, pos)
+    pos += 2
+    if tag == b"s":
+        return bytes(data[pos:pos + length]).decode("utf-8"), pos + length
+    elif tag == b"l":
+        result = []
+        for i in range(length):
+            value, pos = _unpack(data, pos)
+            result.append(value)
+        return result, pos
+    elif tag == b"m":
+        result = {}
+        for i in range(length):
+            key, pos = _unpack(data, pos)
+            result[key], pos = _unpack(data, pos)
+        return result, pos
+    raise ValueError("Bad avatar spec data")
+
+
+class AvatarSpec(object):
+    """Everything create_avatar() derives from the hash before it starts
+       drawing: the unicorn and background parameters, the scale factor,
+       the view angles and the shift that centers the unicorn (which
+       depends on the size, hence the size is part of the spec, too).
+
+       render_spec() draws a spec. Specs can be stored or sent elsewhere as
+       JSON (to_json(), from_json()) or in a compact binary form (to_bytes(),
+       from_bytes()); both contain VERSION, and reading a different version
+       raises a ValueError. Two specs are equal if all their values are, so
+       comparing the to_dict() results shows what changed."""
+
+    VERSION = 1
+    MAGIC = b"UNISPEC"
+
+    def __init__(self, size, unicorn, background, scale_factor, y_angle, x_angle, shift):
+        self.size = size
+        self.unicorn = unicorn
+        self.background = background
+        self.scale_factor = scale_factor
+        self.y_angle = y_angle
+        self.x_angle = x_angle
+        self.shift = tuple(shift)
+
+    def to_dict(self):
+        return { "version": self.VERSION,
+                 "size": self.size,
+                 "unicorn": _plain(self.unicorn),
+                 "background": _plain(self.background),
+                 "scale_factor": self.scale_factor,
+                 "y_angle": self.y_angle,
+                 "x_angle": self.x_angle,
+                 "shift": _plain(self.shift),
+               }
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get("version") != cls.VERSION:
+            raise ValueError("Unsupported avatar spec version %s" % d.get("version"))
+        return cls(d["size"], d["unicorn"], d["background"], d["scale_factor"],
+                   d["y_angle"], d["x_angle"], d["shift"])
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys = True, separators = (",", ":"))
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+    def to_bytes(self):
+        out = [self.MAGIC, struct.pack(">H", self.VERSION)]
+        _pack(self.to_dict(), out)
+        return b"".join(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = memoryview(data)
+        if bytes(data[:len(cls.MAGIC)]) != cls.MAGIC:
+            raise ValueError("Not an avatar spec")
+        version, = struct.unpack_from(">H", data, len(cls.MAGIC))
+        if version != cls.VERSION:
+            raise ValueError("Unsupported avatar spec version %s" % version)
+        d, end = _unpack(data, len(cls.MAGIC) + 2)
+        return cls.from_dict(d)
+
+    def __eq__(self, other):
+        return isinstance(other, AvatarSpec) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "AvatarSpec(%s)" % self.to_json()
+
+
+def _parameters(data):
+    # the *_col helpers end up in the data, too
+    return dict((key, value) for key, value in data._data.items() if not callable(value))
 
+
+def _fill(data, parameters):
+    for key, value in parameters.items():
+        setattr(data, key, value)
+    return data
+
+
+def _make_unicorn(unicorndata, unicorn_scale_factor, size):
+    unicorn = Unicorn(unicorndata)
+    unicorn.scale(unicorn_scale_factor * size / 200.0)
+    return unicorn
+
+
+def _spec_and_unicorn(size, hash_val):
+    """Does the randomizing and places the unicorn. Returns the spec and
+       the unicorn, projected, so create_avatar() doesn't have to build
+       it twice."""
     randomizer = Random()
     randint, choice, random = randomizer.randint, randomizer.choice, randomizer.random
     randomizer.seed(hash_val)
@@ -59,13 +247,7 @@ def create_avatar(size, hash_val, with_background = True):
         unicorndata.neck_tilt = -unicorndata.neck_tilt
         unicorndata.face_tilt = -unicorndata.face_tilt
 
-    unicorn = Unicorn(unicorndata)
-    if with_background:
-        im = get_background(size, backgrounddata)
-    else:
-        im = SquareImage.plain(size * 2, (255, 255, 255))
-
-    unicorn.scale(unicorn_scale_factor * size / 200.0)
+    unicorn = _make_unicorn(unicorndata, unicorn_scale_factor, size)
 
     wv = WorldView(y_angle, x_angle, (150, 0, 0), (0, 100))
 
@@ -73,15 +255,411 @@ def create_avatar(size, hash_val, with_background = True):
     headpos = unicorn.head.projection
     shoulderpos = unicorn.shoulder.projection
 
-    headshift = (im.size/2 - headpos[0], im.size/3 - headpos[1])
-    shouldershift = (im.size / 2 - shoulderpos[0], im.size/2 - shoulderpos[1])
+    im_size = size * 2
+    headshift = (im_size/2 - headpos[0], im_size/3 - headpos[1])
+    shouldershift = (im_size / 2 - shoulderpos[0], im_size/2 - shoulderpos[1])
 
     # factor = 1 means center the head at (1/2, 1/3); factor = 0 means
     # center the shoulder at (1/2, 1/2)
     factor = sqrt((unicorn_scale_factor - .5) / 2.5)
-    wv.shift = tuple(c0 + factor * (c1 - c0) for c0, c1 in zip(shouldershift, headshift))
+    shift = tuple(c0 + factor * (c1 - c0) for c0, c1 in zip(shouldershift, headshift))
+
+    spec = AvatarSpec(size, _parameters(unicorndata), _parameters(backgrounddata),
+                      unicorn_scale_factor, y_angle, x_angle, shift)
+    return spec, unicorn
+
+
+def avatar_spec(size, hash_val):
+    """Returns the AvatarSpec of the avatar create_avatar(size, hash_val)
+       would draw."""
+    return _spec_and_unicorn(size, hash_val)[0]
+
+
+def render_spec(spec, with_background = True, backend = "python", format = "bmp", png_level = 6,
+                downsample = False, zbuffer = False, bands = 1):
+    """Draws the avatar described by an AvatarSpec; the other parameters are
+       the ones of create_avatar()."""
+    _check_options(backend, format, zbuffer, bands)
+    unicorn = _make_unicorn(_fill(UnicornData(), spec.unicorn), spec.scale_factor, spec.size)
+    unicorn.project(WorldView(spec.y_angle, spec.x_angle, (150, 0, 0), (0, 100)))
+    return _render(spec, unicorn, with_background, backend, format, png_level, downsample, zbuffer, bands)
+
+
+def _check_options(backend, format, zbuffer = False, bands = 1):
+    """Fails before anything is drawn if the options are bad."""
+    if backend not in backends:
+        raise KeyError(backend)
+    if format not in ("bmp", "png", "gif"):
+        raise ValueError("Unknown format %s" % format)
+    if zbuffer and not hasattr(backends[backend], "depth_buffer"):
+        raise ValueError("The %s backend can't draw with a z-buffer" % backend)
+    if bands < 1:
+        raise ValueError("Can't draw in %s bands" % bands)
+
+
+def _render(spec, unicorn, with_background, backend, format, png_level, downsample, zbuffer = False,
+            bands = 1):
+    """Draws the unicorn, which has to be projected already."""
+    im = _draw(spec, unicorn, with_background, backend, zbuffer, bands)
+    if downsample:
+        im = im.downsampled()
+    return _encode(im, format, png_level)
+
+
+# Smaller avatars are drawn in one go even if create_avatar() is asked for
+# bands: sending the scene to the processes and the rows back (about 5ms)
+# takes about as long as drawing the bands would.
+BAND_MIN_SIZE = 64
+
+
+def _draw(spec, unicorn, with_background, backend, zbuffer = False, bands = 1):
+    wv = WorldView(spec.y_angle, spec.x_angle, (150, 0, 0), spec.shift)
+    unicorn.sort(wv, order = not zbuffer)
+    scene = spec, unicorn, wv, with_background, backend, zbuffer
+    if bands == 1 or spec.size < BAND_MIN_SIZE:
+        return _paint(scene)
+
+    # The bands are drawn in a pool of processes that is kept for the next
+    # time. The sorted scene is pickled only once and goes along with every
+    # band; a process unpickles it only if it's a new one. The processes only
+    # send back the rows of their bands, which are put together here.
+    size = spec.size * 2
+    edges = [size * i // bands for i in range(bands + 1)]
+    data = pickle.dumps(scene, pickle.HIGHEST_PROTOCOL)
+    jobs = [(data, (top, bottom - 1)) for top, bottom in zip(edges, edges[1:]) if top < bottom]
+    rows = chain.from_iterable(_band_pool().imap(_paint_band, jobs))
+    return backends[backend].from_rgb_rows(size, rows)
+
+
+def _paint(scene, band = None):
+    """Draws the sorted scene _draw() puts together, only the rows of band
+       (first and last row) if given."""
+    spec, unicorn, wv, with_background, backend, zbuffer = scene
+    image_class = backends[backend]
+
+    if with_background:
+        im = get_background(spec.size, _fill(BackgroundData(), spec.background), image_class, band = band)
+    else:
+        if band is None:
+            im = image_class.plain(spec.size * 2, (255, 255, 255))
+        else:
+            im = image_class.plain_band(spec.size * 2, (255, 255, 255), *band)
+
+    if zbuffer:
+        unicorn.draw(im, wv, im.depth_buffer())
+    else:
+        unicorn.draw(im, wv)
+    return im
+
+
+# the pool banded _draw() uses, with the id of the process that started it
+# (a forked child mustn't use its parent's pool)
+_pool = None
+
+
+def _band_pool():
+    global _pool
+    if _pool is None or _pool[0] != os.getpid():
+        _pool = os.getpid(), multiprocessing.Pool(os.cpu_count())
+    return _pool[1]
+
+
+# in the pool's processes: the last scene, pickled and unpickled
+_scene = None
+
+
+def _paint_band(job):
+    global _scene
+    data, band = job
+    if _scene is None or _scene[0] != data:
+        _scene = data, pickle.loads(data)
+    im = _paint(_scene[1], band)
+    return list(im._region_rows(0, band[0], im.s, band[1]))
+
+
+def _encode(im, format, png_level):
+    if format == "png":
+        return im.to_png(png_level)
+    elif format == "bmp":
+        return im.to_bmp()
+    elif format == "gif":
+        return im.to_gif()
+    raise ValueError("Unknown format %s" % format)
+
+
+def create_avatar(size, hash_val, with_background = True, backend = "python", format = "bmp", png_level = 6,
+                  downsample = False, cache = None, zbuffer = False, bands = 1):
+    """Returns a unicorn image with *twice* the given size (i.e. with size=128,
+       you'll get a 256x256 image) -- it's aliased, so you'll want to run it
+       through a resizing filter to have an antialiased image of your actual
+       desired size. Alternatively, pass downsample=True to get the antialiased
+       image at the given size directly (see SquareImage.downsampled()).
+
+       backend is a key of graphics.backends; "numpy" is a lot faster at
+       larger sizes, but only available if numpy is installed. "buffer" needs
+       the least memory, and returns a memoryview of the image instead of
+       a bytes object.
+
+       format is "bmp", "png" or "gif"; png_level is the zlib compression
+       level used for PNG. A GIF has at most 256 colors, which is less than
+       most avatars use; see graphics.gif_palette().
+
+       With zbuffer=True, which part of the unicorn is in front is decided
+       pixel by pixel with a depth buffer, instead of by sorting the balls
+       and bones and drawing them back to front. That only needs time for
+       the pixels drawn, not for comparing the parts with each other; the
+       image is almost the same, but not quite (where the sorting has to
+       guess, and around the eyes and the hair). Only the "numpy" backend
+       has a depth buffer; the others raise a ValueError.
+
+       With bands > 1, the image is cut into that many horizontal bands,
+       which are drawn at the same time by a pool of processes (one per CPU,
+       started on first use and then kept), each drawing only the rows of
+       its band and skipping the parts of the unicorn outside of it. The
+       image is the same, it's just there sooner. Avatars smaller than
+       BAND_MIN_SIZE are drawn in one go anyway. Some bands have more unicorn
+       in them than others, so a few bands per CPU even out the work.
+
+       This is render_spec(avatar_spec(size, hash_val), ...), minus building
+       the unicorn twice.
+
+       cache is one of the caches from cache.py (or anything with the same
+       get() and put()); images found there are returned as they are."""
+
+    _check_options(backend, format, zbuffer, bands)
+
+    if cache is not None:
+        key = avatar_key(size, hash_val, with_background, format, png_level, downsample, zbuffer)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    spec, unicorn = _spec_and_unicorn(size, hash_val)
+    result = _render(spec, unicorn, with_background, backend, format, png_level, downsample, zbuffer, bands)
+
+    if cache is not None:
+        cache.put(key, bytes(result))
+    return result
+
 
+def create_avatar_pyramid(sizes, hash_val, with_background = True, backend = "python", format = "bmp",
+                          png_level = 6, downsample = False, zbuffer = False, bands = 1):
+    """Returns a dict that maps each of the given sizes to the image
+       create_avatar(size, hash_val, ...) would return, but only draws the
+       unicorn once, at the largest size. Each smaller size is a 2x2 box
+       filter reduction of the next bigger one (see SquareImage.downsampled()),
+       hence all sizes have to be the largest one divided by a power of two.
+
+       Everything in the layout scales with the size, so the reduced images
+       show the same picture; they are antialiased versions of it though, not
+       pixel for pixel what create_avatar() draws for the smaller size."""
+    sizes = sorted(set(sizes), reverse = True)
+    if not sizes:
+        raise ValueError("No sizes given")
+    largest = sizes[0]
+    for size in sizes:
+        ratio = largest // size
+        if largest % size or ratio & (ratio - 1):
+            raise ValueError("Size %s isn't %s divided by a power of two" % (size, largest))
+    _check_options(backend, format, zbuffer, bands)
+
+    spec, unicorn = _spec_and_unicorn(largest, hash_val)
+    im = _draw(spec, unicorn, with_background, backend, zbuffer, bands)
+    if downsample:
+        im = im.downsampled()
+
+    result = {}
+    size = largest
+    while True:
+        if size in sizes:
+            result[size] = _encode(im, format, png_level)
+        if size == sizes[-1]:
+            return result
+        im = im.downsampled()
+        size //= 2
+
+
+def _drawn_things(unicorn, wv):
+    """Sorts the projected unicorn and describes how it's going to be drawn:
+       for each thing, in the order they were added to the figure, its
+       position in the drawing order (None if it isn't drawn at all), its
+       bounding box in image coordinates, what its pixels depend on, and the
+       thing itself."""
+    things = list(unicorn._things)
     unicorn.sort(wv)
-    unicorn.draw(im, wv)
+    position = dict((id(thing), i) for i, thing in enumerate(unicorn._things))
+    dx, dy = wv.shift
+    result = []
+    for thing in things:
+        rect = thing.bounding()
+        slack = BOUNDING_SLACK
+        rect = Rect(rect.left + dx - slack, rect.top + dy - slack, rect.right + dx + slack, rect.bottom + dy + slack)
+        looks = tuple((ball.projection[0], ball.projection[1], ball.radius, ball.color) for ball in thing.balls())
+        result.append((position.get(id(thing)), rect, looks, thing))
+    return result
+
+
+def _changed_rect(before, after):
+    """Given the _drawn_things() of two frames, returns the rect that has to
+       be redrawn to turn the first into the second, or None if they look
+       the same."""
+    changed = None
+    unchanged = []
+    for i, ((pos0, rect0, looks0, _), (pos1, rect1, looks1, _)) in enumerate(zip(before, after)):
+        if looks0 != looks1 or (pos0 is None) != (pos1 is None):
+            if pos0 is not None:
+                changed = rect0 + changed
+            if pos1 is not None:
+                changed = rect1 + changed
+        elif pos1 is not None:
+            unchanged.append(i)
+
+    # Things that stayed where they were can still be drawn in a different
+    # order now; that only matters where they overlap.
+    for a, b in overlapping_pairs([after[i][1] for i in unchanged]):
+        i, j = unchanged[a], unchanged[b]
+        if (before[i][0] < before[j][0]) != (after[i][0] < after[j][0]):
+            rect1, rect2 = after[i][1], after[j][1]
+            changed = Rect(max(rect1.left, rect2.left), max(rect1.top, rect2.top),
+                           min(rect1.right, rect2.right), min(rect1.bottom, rect2.bottom)) + changed
+    return changed
+
+
+def _pixel_box(rect, s):
+    """The pixels (left, top, right, bottom; inclusive) of an image with
+       maximum coordinate s that rect covers, or None."""
+    left, top = max(0, int(floor(rect.left))), max(0, int(floor(rect.top)))
+    right, bottom = min(s, int(ceil(rect.right))), min(s, int(ceil(rect.bottom)))
+    if left > right or top > bottom:
+        return None
+    return left, top, right, bottom
+
+
+def create_animation(size, hash_val, frames = 12, delay = 80, with_background = True, backend = "python",
+                     format = "png", png_level = 6, downsample = False):
+    """Returns an animated PNG (or, with format="gif", GIF) of the unicorn going through one cycle of its
+       gait (gallop, walk, ...) in the given number of frames, each shown for
+       delay milliseconds. The first frame is what create_avatar() draws; in
+       each one after that, the pose is 1 / frames of the cycle further on.
+       The other parameters are the ones of create_avatar().
+
+       Only the legs move, so the background is drawn once, and each frame
+       only redraws the rectangle in which something changed (i.e. things
+       that moved, and things that are drawn in a different order now); that
+       rectangle is also all that's stored of the frame in the file. A GIF
+       has one palette for all frames."""
+    if frames < 1:
+        raise ValueError("Need at least one frame")
+    if format not in ("png", "gif"):
+        raise ValueError("Unknown animation format %s" % format)
+    _check_options(backend, format)
+    image_class = backends[backend]
+
+    spec, unicorn = _spec_and_unicorn(size, hash_val)
+    if with_background:
+        background = get_background(size, _fill(BackgroundData(), spec.background), image_class)
+    else:
+        background = image_class.plain(size * 2, (255, 255, 255))
+    projection = WorldView(spec.y_angle, spec.x_angle, (150, 0, 0), (0, 100))
+    wv = WorldView(spec.y_angle, spec.x_angle, (150, 0, 0), spec.shift)
+
+    # im is the current frame; the things that touch the changed rect are
+    # drawn completely on scratch, and the rect is copied over from there.
+    im = background.copy()
+    scratch = background.copy()
+    s = im.s
+    result = []
+    before = None
+    for k in range(frames):
+        if k:
+            parameters = dict(spec.unicorn, pose_phase = (spec.unicorn["pose_phase"] + k / frames) % 1)
+            unicorn = _make_unicorn(_fill(UnicornData(), parameters), spec.scale_factor, size)
+            unicorn.project(projection)
+        after = _drawn_things(unicorn, wv)
+
+        if before is None:
+            unicorn.draw(im, wv)
+            box = 0, 0, s, s
+        else:
+            changed = _changed_rect(before, after)
+            box = changed and _pixel_box(changed, s)
+            if box is not None:
+                redrawn = sorted((entry for entry in after if entry[0] is not None and entry[1].intersects(changed)),
+                                 key = lambda entry: entry[0])
+                dirty = _pixel_box(sum((entry[1] for entry in redrawn), changed), s)
+                scratch.copy_rect(background, *dirty)
+                for entry in redrawn:
+                    entry[3].draw(scratch, wv)
+                im.copy_rect(scratch, *box)
+            else:
+                # nothing changed, but the frame still has to be there
+                box = 0, 0, 0, 0
+        before = after
+
+        left, top, right, bottom = box
+        if downsample:
+            left, top, right, bottom = left // 2, top // 2, right // 2, bottom // 2
+            rows = list(reduce_rows(im._region_rows(2 * left, 2 * top, 2 * right + 1, 2 * bottom + 1),
+                                    2 * (right - left + 1)))
+        else:
+            rows = list(im._region_rows(left, top, right, bottom))
+        result.append((left, top, right - left + 1, bottom - top + 1, delay, rows))
+
+    out = io.BytesIO()
+    out_size = size if downsample else 2 * size
+    if format == "gif":
+        counts = None
+        for frame in result:
+            counts = color_counts(frame[5], counts)
+        palette, mapping = gif_palette(counts)
+        result = [frame[:5] + (index_rows(frame[5], mapping),) for frame in result]
+        write_gif(out, out_size, out_size, result, palette)
+    else:
+        write_apng(out, out_size, out_size, result, png_level)
+    return out.getvalue()
+
+
+def _warm_up(size, options):
+    """Runs once in every worker of create_avatars(): fills the span tables
+       and the other caches by drawing a throwaway avatar."""
+    warm_span_tables(size)
+    create_avatar(size, 0, **options)
+
+
+def _create_one(job):
+    hash_val, size, options = job
+    try:
+        return hash_val, bytes(create_avatar(size, hash_val, **options))
+    except Exception as e:
+        return hash_val, e
+
+
+def create_avatars(hashes, size, with_background = True, backend = "python", format = "bmp", png_level = 6,
+                   downsample = False, workers = None, chunksize = 16, ordered = True, zbuffer = False):
+    """Renders many avatars in a pool of worker processes (workers of them,
+       by default one per CPU). Returns an iterator that yields a
+       (hash_val, result) pair for every hash, where result is what
+       create_avatar() returns (always as bytes) or, if rendering that hash
+       failed, the exception it raised. Bad options raise right away.
+
+       The hashes are sent to the workers chunksize at a time. With
+       ordered=False, results come back as soon as they are ready instead
+       of in the order of hashes. The pool is shut down when the iterator
+       is exhausted or closed."""
+    options = dict(with_background = with_background, backend = backend, format = format,
+                   png_level = png_level, downsample = downsample, zbuffer = zbuffer)
+    # fail right here on bad options, not once per hash (nor only once the
+    # results are asked for, which is when a generator's body starts)
+    _check_options(backend, format, zbuffer)
+    return _results(hashes, size, options, workers, chunksize, ordered)
+
 
-    return im.to_bmp()
+def _results(hashes, size, options, workers, chunksize, ordered):
+    jobs = ((hash_val, size, options) for hash_val in hashes)
+    with multiprocessing.Pool(workers or os.cpu_count(), _warm_up, (size, options)) as pool:
+        if ordered:
+            results = pool.imap(_create_one, jobs, chunksize)
+        else:
+            results = pool.imap_unordered(_create_one, jobs, chunksize)
+        for result in results:
+            yield result
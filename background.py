@@ -16,8 +16,14 @@
 # along with Unicornify; see the file COPYING. If not, see
 # <http://www.gnu.org/licenses/>.
 
-from graphics import SquareImage, hls_to_rgb
+from graphics import SquareImage, ArrayImage, hls_to_rgb, circle_lines, line_extents
 from core import Data
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class BackgroundData(Data):
@@ -59,8 +65,64 @@ class BackgroundData(Data):
         self.cloud_lightnesses = [randint(75, 90) for c in self.cloud_positions]
 
 
-def get_background(size, data):  # return size is 2*size!
-    im = SquareImage(size * 2, data.sky_col(60), data.sky_col(10))
+class LayerCache(object):
+    """Keeps the background layers that only depend on a few BackgroundData
+       fields (and the size and image class), so they don't have to be drawn
+       again for every avatar. When the cached layers take more than budget
+       bytes, the least recently used ones are dropped. hits and misses count
+       the lookups."""
+
+    def __init__(self, budget = 64 * 2**20):
+        self.budget = budget
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._layers = OrderedDict()
+
+    def get(self, key, make):
+        """Returns the layer stored under key, calling make() to draw it if
+           it's not there. The layer is shared, so don't draw on it."""
+        layer = self._layers.get(key)
+        if layer is not None:
+            self.hits += 1
+            self._layers.move_to_end(key)
+            return layer
+
+        self.misses += 1
+        layer = make()
+        if layer.nbytes <= self.budget:
+            self._layers[key] = layer
+            self.used += layer.nbytes
+            while self.used > self.budget:
+                key, old = self._layers.popitem(last = False)
+                self.used -= old.nbytes
+        return layer
+
+    def clear(self):
+        self._layers.clear()
+        self.used = 0
+
+
+layer_cache = LayerCache()
+
+
+def get_background(size, data, image_class = SquareImage, cache = layer_cache, band = None):  # return size is 2*size!
+    """The sky and the land come from cache (pass None to draw them from
+       scratch); the rainbow and the clouds are drawn on top. With a band
+       (first row, last row), only the rows of the band are drawn, on an
+       image from plain_band(); the layers aren't used then, since only
+       their rows in the band would be needed."""
+    if cache is None:
+        cache = LayerCache(budget = 0)
+    s = 2 * size - 1
+
+    if band is None:
+        sky = cache.get(("sky", image_class, size, data.sky_hue, data.sky_sat),
+                        lambda: image_class(size * 2, data.sky_col(60), data.sky_col(10)))
+        im = sky.copy()
+    else:
+        im = image_class.plain_band(size * 2, (0, 0, 0), *band)
+        sky_rows(im, data.sky_col(60), data.sky_col(10))
 
     horizon_pix = int(im.size * data.horizon)
 
@@ -68,24 +130,41 @@ def get_background(size, data):  # return size is 2*size!
     outer_radius = data.rainbow_height * im.size
     delta = data.rainbow_band_width * im.size
 
-    im.save()
-
-    for w in range(7):
-        col = hls_to_rgb(w * 45, 50, 100)
-        im.circle(center, outer_radius - w * delta, col)
-
-    im.circle(center, outer_radius - 7 * delta, im.RESTORE)
-
-    land1 = data.land_col(data.land_light)
-    land2 = data.land_col(data.land_light / 2)
-    im.hor_gradient(land1, land2, 0, 2 * size - 1, horizon_pix, 2 * size - 1)
+    # seven bands, and the sky shows through the innermost circle
+    radii = [outer_radius - w * delta for w in range(8)]
+    colors = [hls_to_rgb(w * 45, 50, 100) for w in range(7)] + [None]
+    im.annuli(center, radii, colors)
+
+    # the land gradient is the same in every row, so one layer fits every horizon
+    def land():
+        layer = image_class.plain(size * 2, (0, 0, 0))
+        layer.hor_gradient(data.land_col(data.land_light), data.land_col(data.land_light / 2), 0, s, 0, s)
+        return layer
+    if band is None:
+        im.copy_rows(cache.get(("land", image_class, size, data.land_hue, data.land_sat, data.land_light), land),
+                     horizon_pix, s)
+    else:
+        im.hor_gradient(data.land_col(data.land_light), data.land_col(data.land_light / 2), 0, s, horizon_pix, s)
 
     for pos, sizes, lightness in zip(data.cloud_positions, data.cloud_sizes, data.cloud_lightnesses):
-        cloud(im, (im.size * pos[0], im.size * pos[1]), sizes[0] * im.size, sizes[1] * sizes[0] * im.size, data.sky_col(lightness))
+        args = ((im.size * pos[0], im.size * pos[1]), sizes[0] * im.size, sizes[1] * sizes[0] * im.size)
+        if isinstance(im, ArrayImage):
+            im.fill_lines(*cloud_lines(im.size, *args), colors = data.sky_col(lightness))
+        else:
+            cloud(im, *args, color = data.sky_col(lightness))
 
     return im
 
 
+def sky_rows(img, top_color, bottom_color):
+    """Fills the rows of img's band with the colors they have in the image
+       class's gradient from top_color to bottom_color."""
+    delta = [b - t for b, t in zip(bottom_color, top_color)]
+    top, bottom = img.band
+    for y in range(top, bottom + 1):
+        img.hor_line(tuple(t + d * y // img.s for t, d in zip(top_color, delta)), 0, img.s, y)
+
+
 def cloud(img, pos, size1, size2, color):
     """sizeX is a radius of one of the circles. size2 should be
        between 100 and 200% of size1. pos is bottom center."""
@@ -97,3 +176,20 @@ def cloud(img, pos, size1, size2, color):
     img.top_half_circle((x, y-size1), size2, color)
     for ly in range(y - size1, y + 1):
         img.hor_line(color, x - 2 * size1, x + 2 * size1, ly)
+
+
+def cloud_lines(img_size, pos, size1, size2):
+    """The lines that cloud() draws on an image of size img_size, as numpy
+       arrays like graphics.circle_lines() returns. Since the whole cloud has
+       one color, lines that overlap don't matter."""
+    x, y = map(int, pos)
+    size1, size2 = int(size1), int(size2)
+    s = img_size - 1
+    parts = [circle_lines(img_size, (x - 2 * size1, y - size1 - 1), size1),
+             circle_lines(img_size, (x + 2 * size1, y - size1 - 1), size1),
+             circle_lines(img_size, (x, y - size1), size2, top_half = True)]
+
+    rows = numpy.arange(max(0, y - size1), min(s, y) + 1)
+    parts.append((rows,) + line_extents(img_size, x, numpy.full(len(rows), 2 * size1)))
+
+    return tuple(numpy.concatenate(column) for column in zip(*parts))
@@ -0,0 +1,253 @@
+# Copyright 2010 Benjamin Dumke
+#
+# This file is part of Unicornify
+#
+# Unicornify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Unicornify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the NU Affero General Public License
+# along with Unicornify; see the file COPYING. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Caches for rendered avatars. A cache maps keys (the 20 byte digests
+   avatar.avatar_key() returns) to encoded images; it has get(key), which
+   returns bytes or None, and put(key, data). Pass one as
+   create_avatar()'s cache parameter; TieredCache puts a MemoryCache in
+   front of a DiskCache."""
+
+from collections import OrderedDict
+from binascii import hexlify, unhexlify
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+
+class DiskCache(object):
+    """Keeps the images as files in directory, one per key, until they take
+       more than budget bytes; then the least recently used ones are
+       deleted. Files are written to a temporary name and renamed, so
+       readers never see a partial file. Hits are read in one go through
+       an mmap of the file.
+
+       The LRU order lives in memory and is saved to a compact index file
+       (20 byte key and 8 byte size per entry) every index_interval puts
+       and on close(); files the index doesn't know about (say, after a
+       crash) are picked up when the cache is opened. Only one DiskCache
+       should write to a directory at a time."""
+
+    INDEX_MAGIC = b"UNICACHE"
+    INDEX_VERSION = 1
+
+    def __init__(self, directory, budget = 2**30, index_interval = 256):
+        self.directory = directory
+        self.budget = budget
+        self.index_interval = index_interval
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._unsaved = 0
+        os.makedirs(directory, exist_ok = True)
+        self._load_index()
+
+    def _path(self, key):
+        name = hexlify(key).decode("ascii")
+        return os.path.join(self.directory, name[:2], name)
+
+    def _index_path(self):
+        return os.path.join(self.directory, "index")
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        header = self.INDEX_MAGIC + struct.pack(">H", self.INDEX_VERSION)
+        known = OrderedDict()
+        if data.startswith(header):
+            for offset in range(len(header), len(data) - 27, 28):
+                key = data[offset:offset + 20]
+                known[key], = struct.unpack_from(">Q", data, offset + 20)
+
+        # Files that aren't in the index are the oldest as far as we know;
+        # entries whose files are gone are dropped.
+        found = []
+        for sub in os.listdir(self.directory):
+            path = os.path.join(self.directory, sub)
+            if len(sub) != 2 or not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if len(name) != 40 or not name.startswith(sub):
+                    continue
+                try:
+                    key = unhexlify(name)
+                    stat = os.stat(os.path.join(path, name))
+                except (ValueError, OSError):
+                    continue
+                found.append((stat.st_mtime, key, stat.st_size))
+        sizes = dict((key, size) for mtime, key, size in found)
+        for mtime, key, size in sorted(found):
+            if key not in known:
+                self._entries[key] = size
+        for key in known:
+            if key in sizes:
+                self._entries[key] = sizes[key]
+        self.used = sum(self._entries.values())
+        self._evict()
+
+    def save_index(self):
+        header = self.INDEX_MAGIC + struct.pack(">H", self.INDEX_VERSION)
+        records = b"".join(key + struct.pack(">Q", size) for key, size in self._entries.items())
+        self._write_atomically(self._index_path(), header + records)
+        self._unsaved = 0
+
+    def close(self):
+        self.save_index()
+
+    def _write_atomically(self, path, data):
+        directory = os.path.dirname(path)
+        fd, temp = tempfile.mkstemp(dir = directory, prefix = ".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp, path)
+        except BaseException:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+
+    def get(self, key):
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapping:
+                    data = bytes(mapping)
+        except (OSError, ValueError):
+            # gone (or emptied) behind our back
+            self.used -= self._entries.pop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        size = len(data)
+        if size > self.budget:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        self._write_atomically(path, data)
+        self.used += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        self._evict()
+
+        self._unsaved += 1
+        if self._unsaved >= self.index_interval:
+            self.save_index()
+
+    def _evict(self):
+        while self.used > self.budget:
+            key, size = self._entries.popitem(last = False)
+            self.used -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MemoryCache(object):
+    """Keeps images in memory until they take more than budget bytes (the
+       data itself, not counting per entry overhead); then the least
+       recently used ones are dropped. With a ttl (in seconds), entries
+       older than that count as missing. Keys include the size, so the
+       same hash can be in the cache at several sizes."""
+
+    def __init__(self, budget = 256 * 2**20, ttl = None, clock = time.monotonic):
+        self.budget = budget
+        self.ttl = ttl
+        self.clock = clock
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        data, expires = entry
+        if expires is not None and self.clock() >= expires:
+            del self._entries[key]
+            self.used -= len(data)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        data = bytes(data)
+        if len(data) > self.budget:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.used -= len(old[0])
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self._entries[key] = data, expires
+        self.used += len(data)
+        while self.used > self.budget:
+            key, (data, expires) = self._entries.popitem(last = False)
+            self.used -= len(data)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.used = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TieredCache(object):
+    """Tries the caches in order; a hit in a later (slower) cache is put
+       into the earlier ones, and put() stores in all of them."""
+
+    def __init__(self, *caches):
+        self.caches = caches
+
+    def get(self, key):
+        for i, cache in enumerate(self.caches):
+            data = cache.get(key)
+            if data is not None:
+                for faster in self.caches[:i]:
+                    faster.put(key, data)
+                return data
+        return None
+
+    def put(self, key, data):
+        for cache in self.caches:
+            cache.put(key, data)
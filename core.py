@@ -17,61 +17,82 @@
 # <http://www.gnu.org/licenses/>.
 
 from math import sin, cos, pi, sqrt
-import functools
+from functools import lru_cache
+from bisect import bisect_right
+import heapq
 from graphics import hls_to_rgb
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def cmp(a, b):
     return (a > b) - (a < b)
 
 
 class Data(object):
-    def __getattribute__(self, attr):
-        try:
-            return super(Data, self).__getattribute__(attr)
-        except AttributeError:
-            if attr in self._data:
-                return self._data[attr]
-            elif attr.endswith("_col"):
-                part = attr[:-4]
-                func = lambda lightness: hls_to_rgb(self._data[part + "_hue"], lightness, self._data[part + "_sat"])
-                self._data[attr] = func
-                return func
-            else:
-                raise KeyError("Unknown parameter %s" % attr)
+    """The parameters are the instance's attributes -- assigning _data
+       makes the given dict the instance dict -- so reading them is an
+       ordinary attribute lookup. Only unknown names end up in __getattr__."""
+
+    @property
+    def _data(self):
+        return self.__dict__
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        data = self.__dict__
+        if attr.endswith("_col"):
+            part = attr[:-4]
+            func = lambda lightness: hls_to_rgb(data[part + "_hue"], lightness, data[part + "_sat"])
+            data[attr] = func
+            return func
+        else:
+            raise KeyError("Unknown parameter %s" % attr)
 
     def __setattr__(self, attr, value):
         if attr == "_data":
-            super(Data, self).__setattr__(attr, value)
-        elif attr in self._data:
-            self._data[attr] = value
+            super(Data, self).__setattr__("__dict__", value)
+        elif attr in self.__dict__:
+            self.__dict__[attr] = value
         else:
             raise KeyError("Unknown parameter %s" % attr)
 
 
+# How far the pixels a thing draws can stick out of its bounding(), from
+# rounding the centers and radii to whole pixels.
+BOUNDING_SLACK = 2
+
+
 class Rect(object):
+    __slots__ = ("left", "top", "right", "bottom")
+
     def __init__(self, left, top, right, bottom):
-        self.coords = left, top, right, bottom
         self.left = left
         self.right = right
         self.top = top
         self.bottom = bottom
 
+    @property
+    def coords(self):
+        return self.left, self.top, self.right, self.bottom
+
     def __add__(self, other):
         if other is None:
             return self
-        zipped = list(zip(self.coords, other.coords))
-        lt = list(map(min, zipped[:2]))
-        rb = list(map(max, zipped[2:]))
-        return Rect(*(lt + rb))
+        return Rect(min(self.left, other.left), min(self.top, other.top),
+                    max(self.right, other.right), max(self.bottom, other.bottom))
 
     def __radd__(self, other):
         return self + other
 
     def intersects(self, other):
-        hori = other.left <= self.left <= other.right or other.left <= self.right <= other.right or (self.left <= other.left and self.right >= other.right)
-        vert = other.top <= self.top <= other.bottom or other.top <= self.bottom <= other.bottom or (self.top <= other.top and self.bottom >= other.bottom)
-        return hori and vert
+        # the intervals are closed, so touching rects intersect
+        return (other.left <= self.right and self.left <= other.right and
+                other.top <= self.bottom and self.top <= other.bottom)
 
 
 class WorldView(object):
@@ -82,48 +103,78 @@ class WorldView(object):
         self.angle_x = angle_x
         self.rotation_center = rotation_center
         self.shift = shift
+        self._rotation = None
+
+    @property
+    def matrix(self):
+        """The rotation around the y axis followed by the one around the x axis,
+           as a tuple of rows. It's only recomputed when the angles change."""
+        angles = (self.angle_y, self.angle_x)
+        if self._rotation is None or self._rotation[0] != angles:
+            rad_y = self.angle_y * pi / 180
+            rad_x = self.angle_x * pi / 180
+            cy, sy, cx, sx = cos(rad_y), sin(rad_y), cos(rad_x), sin(rad_x)
+            matrix = ((cy, 0., -sy),
+                      (-sx * sy, cx, -sx * cy),
+                      (cx * sy, sx, cx * cy))
+            self._rotation = angles, matrix
+        return self._rotation[1]
+
+    def project(self, point):
+        (a, b, c), (d, e, f), (g, h, i) = self.matrix
+        rx, ry, rz = self.rotation_center
+        x, y, z = point[0] - rx, point[1] - ry, point[2] - rz
+        return (a * x + b * y + c * z + rx, d * x + e * y + f * z + ry, g * x + h * y + i * z + rz)
+
+    def project_points(self, points):
+        """Same as project(), but for a whole n x 3 numpy array of points at
+           once. The arithmetic is done in the same order, so the results
+           are exactly the same."""
+        m = numpy.array(self.matrix)
+        center = numpy.array(self.rotation_center, float)
+        p = points - center
+        return p[:, :1] * m[:, 0] + p[:, 1:2] * m[:, 1] + p[:, 2:] * m[:, 2] + center
 
 
 class Ball(object):
+    __slots__ = ("center", "radius", "color", "projection", "_bounding", "_pending_in")
+
     def __init__(self, center, radius, color):
         self.center = tuple(map(float, center))
         self.radius = float(radius)
         self.color = color
 
         self.projection = None
+        self._bounding = None
+        # the figures with rotate() or scale() recorded for this ball, but not
+        # applied yet; until they are, center and radius are out of date
+        self._pending_in = None
 
     def project(self, worldview):
-        rad_y = worldview.angle_y * pi / 180
-        rad_x = worldview.angle_x * pi / 180
-        x1, y1, z1 = (self.center[i] - worldview.rotation_center[i] for i in range(3))
-        x2 = x1 * cos(rad_y) - z1 * sin(rad_y)
-        y2 = y1
-        z2 = x1 * sin(rad_y) + z1 * cos(rad_y)
-        x3 = x2
-        y3 = y2 * cos(rad_x) - z2 * sin(rad_x)
-        z3 = y2 * sin(rad_x) + z2 * cos(rad_x)
-        self.projection = tuple(c[0] + c[1] for c in zip((x3, y3, z3), worldview.rotation_center))
+        self.projection = worldview.project(self.center)
 
     def rotate(self, angle, other, axis = 2):
         """Rotate this ball around the ball "other", leaving the "axis" coordinate
            as is. (default z, i.e. rotation is in the x-y-plane)"""
-        rad = angle * pi / 180
-        swap = [(1, 2, 0), (0, 2, 1), (0, 1, 2)][axis]
-        reverse = [(2, 0, 1), (0, 2, 1), (0, 1, 2)][axis]
-        # the letters are the correct ones for the default case axis = 2
-        x1, y1, z1 = (self.center[i] - other.center[i] for i in swap)
-        x2 = x1 * cos(rad) - y1 * sin(rad)
-        y2 = x1 * sin(rad) + y1 * cos(rad)
-        z2 = z1
-        self.center = tuple((x2, y2, z2)[reverse[i]] + other.center[i] for i in range(3))
+        self._check_current(other)
+        x, y, z = self - other
+        self.center = tuple(r[0] * x + r[1] * y + r[2] * z + c for r, c in zip(rotation_matrix(angle, axis), other.center))
 
     def set_distance(self, distance, other):
         """Move this ball to have the given distance to "other" while not changing the
            direction. This is the distance of the ball centers."""
+        self._check_current(other)
         span = tuple(c[0] - c[1] for c in zip(self.center, other.center))
         stretch = distance / sqrt(sum(c * c for c in span))
         self.center = tuple(c[0] + stretch * c[1] for c in zip(other.center, span))
 
+    def _check_current(self, other):
+        """Moving a ball only works with up to date centers, i.e. not while a
+           figure still has a rotation or scaling of it (or other) pending."""
+        for ball in (self, other):
+            if ball._pending_in:
+                raise ValueError("A figure has transforms of this ball pending; call its apply_transforms() first")
+
     def set_gap(self, gap, other):
         self.set_distance(gap + self.radius + other.radius, other)
 
@@ -133,9 +184,12 @@ class Ball(object):
     def twoD(self):
         return self.projection[:2]
 
-    def draw(self, image, worldview):
+    def draw(self, image, worldview, depth = None, host = None):
         x, y = map(sum, zip(worldview.shift, self.twoD()))
         r = self.radius
+        if depth is not None:
+            image.depth_circles([((x, y), r, self.projection[2], self.color)], depth, host_sphere(host, worldview))
+            return
         image.circle((x, y), r, self.color)
 
     def __sub__(self, other):
@@ -147,29 +201,83 @@ class Ball(object):
         return tuple(c[0] - c[1] for c in zip(tup1, tup2))
 
     def bounding(self):
-        x, y, r = self.twoD() + (self.radius, )
-        return Rect(x - r, y - r, x + r, y + r)
+        # Cached along with the projection and the radius it was computed
+        # from; projecting again (or scaling) makes it stale.
+        cached = self._bounding
+        if cached is not None and cached[0] is self.projection and cached[1] == self.radius:
+            return cached[2]
+        x, y = self.projection[0], self.projection[1]
+        r = self.radius
+        rect = Rect(x - r, y - r, x + r, y + r)
+        self._bounding = self.projection, r, rect
+        return rect
 
     def balls(self):
         yield self
 
-    def sort(self, worldview):
+    def sort(self, worldview, order = True):
         return
 
 
+@lru_cache(maxsize = 1024)
+def rotation_matrix(angle, axis = 2):
+    """The rotation done by Ball.rotate(), as a tuple of rows."""
+    rad = angle * pi / 180
+    c, s = cos(rad), sin(rad)
+    i, j = [(1, 2), (0, 2), (0, 1)][axis]
+    m = [[0., 0., 0.], [0., 0., 0.], [0., 0., 0.]]
+    m[axis][axis] = 1.
+    m[i][i], m[i][j] = c, -s
+    m[j][i], m[j][j] = s, c
+    return tuple(map(tuple, m))
+
+
+# An affine transform is a pair (matrix, offset), mapping p to matrix * p + offset.
+
+IDENTITY = (((1., 0., 0.), (0., 1., 0.), (0., 0., 1.)), (0., 0., 0.))
+
+
+def transformed(affine, point):
+    m, offset = affine
+    x, y, z = point
+    return tuple(r[0] * x + r[1] * y + r[2] * z + o for r, o in zip(m, offset))
+
+
+def compose(after, before):
+    """The affine transform that applies before, then after."""
+    a, b = after[0], before[0]
+    m = tuple(tuple(a[i][0] * b[0][j] + a[i][1] * b[1][j] + a[i][2] * b[2][j] for j in range(3)) for i in range(3))
+    return m, transformed(after, before[1])
+
+
 def identity(x):
     return x
 
 
+def host_sphere(host, worldview):
+    """The ball host (see Figure.put_on()) as the (center, radius, z) that
+       the images' depth_circles() and depth_capsule() take, or None."""
+    if host is None:
+        return None
+    return tuple(map(sum, zip(worldview.shift, host.twoD()))), host.radius, host.projection[2]
+
+
 class Bone(object):
+    __slots__ = ("_balls", "_bounding")
+
     def __init__(self, ball1, ball2):
         self._balls = [ball1, ball2]
+        self._bounding = None
 
-    def draw(self, image, worldview, xfunc = identity, yfunc = identity):
+    def draw(self, image, worldview, xfunc = identity, yfunc = identity, depth = None, host = None):
         """xfunc and / or yfunc should map [0,1] -> [0,1] if the parameter "step"
            should not be applied linearly to the coordinates. Note that these x and
            y are screen, i.e. 2D, coordinates. This is currently used to make the hair
-           wavy."""
+           wavy.
+
+           With a depth buffer (see Figure.draw()), the bone is drawn where
+           it's closer than what's already there; host is the ball it lies
+           on, if any (see Figure.put_on())."""
 
         calc = lambda c1, c2, factor: c1 + (c2 - c1) * factor
         x1, y1 = map(sum, zip(self[0].twoD(), worldview.shift))
@@ -181,26 +289,35 @@ class Bone(object):
         steps = max(steps, abs(self[0].radius - self[1].radius))
         colors = list(zip(self[0].color, self[1].color))
 
-        # the old way is faster for smaller images, the new one for larger ones.
-        # This table shows test measurings. Note that the size is the final size,
-        # i.e. half the drawing size. O means the old one is faster, N the new one.
-        #
-        # zoom    test hash         32  64  128 256 512
-        # ----------------------------------------------
-        # close   21b96dcc68138     O   N   N   N!  N!
-        # medium  18011847b11145af  O!  O   =   N   N
-        # far     1895854ba5a70     O!  O!  O   =   N
-
-        if xfunc is identity and yfunc is identity:
-            if steps > 80: # based on tests, this number seems roughly to be the break-even point
-                image.connect_circles((x1, y1), self[0].radius, self[0].color, (x2, y2), self[1].radius, self[1].color)
+        # A straight bone is the convex hull of its two end circles, which
+        # connect_circles() rasterizes row by row, touching each covered pixel
+        # once. Stamping steps + 1 circles instead overdraws most pixels many
+        # times. Still, bones of up to 80 steps are stamped like they always
+        # were, so the avatars don't change (see ALGORITHM_VERSION): short
+        # bones like the eyes keep the round outline of the circles, and at
+        # those lengths both ways take about the same time. Bent bones (i.e.
+        # the hair) are always stamped, their outline isn't that simple.
+        z1, z2 = self[0].projection[2], self[1].projection[2]
+        if xfunc is identity and yfunc is identity and steps > 80:
+            if depth is not None:
+                image.depth_capsule((x1, y1), self[0].radius, z1, self[0].color,
+                                    (x2, y2), self[1].radius, z2, self[1].color, depth,
+                                    host_sphere(host, worldview))
                 return
+            image.connect_circles((x1, y1), self[0].radius, self[0].color, (x2, y2), self[1].radius, self[1].color)
+            return
 
+        circles = []
         for step in range(int(steps + 1)):
             factor = float(step) / steps
             color = tuple(map(int, (calc(c[0], c[1], factor) for c in colors)))
             x, y, r = calc(x1, x2, xfunc(factor)), calc(y1, y2, yfunc(factor)), calc(self[0].radius, self[1].radius, factor)
-            image.circle((x, y), r, color)
+            if depth is not None:
+                circles.append(((x, y), r, calc(z1, z2, factor), color))
+            else:
+                image.circle((x, y), r, color)
+        if circles:
+            image.depth_circles(circles, depth, host_sphere(host, worldview))
 
     def __getitem__(self, index):
         return self._balls[index]
@@ -212,32 +329,49 @@ class Bone(object):
         for ball in self._balls:
             ball.project(worldview)
 
-    def sort(self, worldview):
+    def sort(self, worldview, order = True):
         self._balls.sort(key=lambda ball: ball.projection[2], reverse = True)
 
     def span(self):
         return self[1] - self[0]
 
     def bounding(self):
-        return self[0].bounding() + self[1].bounding()
+        # the balls cache their rects, so as long as they return the same
+        # ones, the sum is still valid
+        rect1, rect2 = self._balls[0].bounding(), self._balls[1].bounding()
+        cached = self._bounding
+        if cached is not None and cached[0] is rect1 and cached[1] is rect2:
+            return cached[2]
+        rect = rect1 + rect2
+        self._bounding = rect1, rect2, rect
+        return rect
 
 
-def reverse(func):
-    def result(v):
-        return 1 - func(1 - v)
-    return result
+class reverse(object):
+    """The function v -> 1 - func(1 - v). A class and not a closure, so
+       figures can be pickled."""
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, v):
+        return 1 - self.func(1 - v)
 
 
 class NonLinBone(Bone):
+    __slots__ = ("_xfunc", "_yfunc")
+
     def __init__(self, ball1, ball2, xfunc = identity, yfunc = identity):
         self._balls = [ball1, ball2]
+        self._bounding = None
         self._xfunc = xfunc
         self._yfunc = yfunc
 
-    def draw(self, image, worldview):
-        super(NonLinBone, self).draw(image, worldview, self._xfunc, self._yfunc)
+    def draw(self, image, worldview, depth = None, host = None):
+        super(NonLinBone, self).draw(image, worldview, self._xfunc, self._yfunc, depth, host)
 
-    def sort(self, worldview):
+    def sort(self, worldview, order = True):
         previous = self._balls[:]
         super(NonLinBone, self).sort(worldview)
         if previous != self._balls:
@@ -270,9 +404,7 @@ def compare(worldview, first, second):
             return compare(worldview, first[1], second)
         else: # the projection is within the bone
             proj = tuple(c[0] * factor + c[1] for c in zip(span, first[0].center))
-            proj_ball = Ball(proj, 1, None)
-            proj_ball.project(worldview)
-            return compare(worldview, proj_ball, second)
+            return cmp(worldview.project(proj)[2], second.projection[2])
     elif isinstance(first, Ball) and isinstance(second, Bone):
         return -compare(worldview, second, first)
     elif isinstance(first, Bone) and isinstance(second, Bone):
@@ -345,81 +477,151 @@ def evilness(thing):
     return -z
 
 
+def overlapping_pairs(rects):
+    """Yields the index pairs (i, j), i < j, of all rects that intersect (in the
+       sense of Rect.intersects()), in no particular order. This sweeps
+       over the rects from left to right, so only rects whose horizontal
+       extents overlap are ever looked at together."""
+    active = []
+    for i in sorted(range(len(rects)), key = lambda i: rects[i].left):
+        rect = rects[i]
+        active = [j for j in active if rects[j].right >= rect.left]
+        for j in active:
+            other = rects[j]
+            if other.top <= rect.bottom and rect.top <= other.bottom:
+                yield (j, i) if j < i else (i, j)
+        active.append(i)
+
+
+def depth_order(things, worldview):
+    """Returns the things in the order they should be drawn, i.e. back to front.
+       Things whose bounding boxes intersect are compared; a thing is only
+       drawn once everything behind it has been drawn. Where these "draw after"
+       constraints can't all be fulfilled, the thing farthest in the back
+       (see evilness()) is drawn next.
+
+       The things ready to be drawn are kept on a stack, and the ones that
+       become ready are pushed in their original order. This is exactly the
+       order the original quadratic implementation (pairwise comparisons,
+       then scanning all constraints after every drawn thing) produced."""
+    rects = [thing.bounding() for thing in things]
+
+    # blockers[i] is the number of things that have to be drawn before
+    # things[i]; dependents[j] are the indices of the things waiting for things[j]
+    blockers = [0] * len(things)
+    dependents = [[] for thing in things]
+    for i, j in overlapping_pairs(rects):
+        c = compare(worldview, things[i], things[j])
+        if c < 0:
+            # things[i] is in front of things[j]
+            blockers[i] += 1
+            dependents[j].append(i)
+        elif c > 0:
+            blockers[j] += 1
+            dependents[i].append(j)
+    for waiting in dependents:
+        waiting.sort()
+
+    waiting = set(i for i, count in enumerate(blockers) if count)
+    ready = [i for i, count in enumerate(blockers) if not count]
+    evil = [(evilness(thing), i) for i, thing in enumerate(things)]
+    heapq.heapify(evil)
+    result = []
+
+    def drawn(i):
+        result.append(things[i])
+        for k in dependents[i]:
+            if k in waiting:
+                blockers[k] -= 1
+                if not blockers[k]:
+                    ready.append(k)
+                    waiting.remove(k)
+
+    # Note that whatever is still on the stack when the last waiting thing
+    # becomes ready isn't drawn; that's what the old implementation did,
+    # and the draw order must stay the same.
+    while waiting:
+        while ready:
+            drawn(ready.pop())
+
+        if waiting:
+            # if the sorting couldn't fullfill all "draw after" contraints,
+            # we remove the ball / bone which lies farthest in the back
+            # and try again
+            while evil[0][1] not in waiting:
+                heapq.heappop(evil)
+            least_evil = heapq.heappop(evil)[1]
+            waiting.remove(least_evil)
+            drawn(least_evil)
+
+    return result
+
+
 class Figure(object):
     def __init__(self):
         self._things = []
+        # (number of things at the time, affine transform, radius factor)
+        # for every rotate() and scale() that hasn't been applied yet
+        self._pending = []
+        # thing -> the ball it lies on, see put_on()
+        self._hosts = {}
 
     def add(self, *things):
         self._things.extend(things)
 
+    def put_on(self, ball, *things):
+        """Says that the given things of this figure (balls or bones) lie on
+           the surface of ball, like the pupils on the eyes, even if they're
+           actually a bit inside of it. Sorting takes care of that when
+           drawing back to front, but with a depth buffer they'd be hidden;
+           so there they're drawn as if they were just in front of ball
+           wherever that covers them."""
+        for thing in things:
+            self._hosts[thing] = ball
+
     def project(self, worldview):
-        for thing in self._things:
-            thing.project(worldview)
-
-    def sort(self, worldview):
-        """this assumes that projection has already happened!"""
-        comp = functools.partial(compare, worldview)
-
-        # values of this dict are lists of all things that have
-        # to be drawn before the corresponding key
-        draw_after = dict((thing, []) for thing in self._things)
-
-        for first, second in two_combinations(self._things):
-            if second not in draw_after[first] and first not in draw_after[second]:
-                if first.bounding().intersects(second.bounding()):
-                    c = comp(first, second)
-                    if c < 0:
-                        # first is in front of second
-                        draw_after[first].append(second)
-                    elif c > 0:
-                        draw_after[second].append(first)
-
-        # this is pretty much the algorithm from http://stackoverflow.com/questions/952302/
-        sorted_things = []
-        queue = []
-        for thing, deps in list(draw_after.items()):
-            if not deps:
-                queue.append(thing)
-                del draw_after[thing]
-
-        while draw_after:
-            while queue:
-                popped = queue.pop()
-                sorted_things.append(popped)
-                for thing, deps in list(draw_after.items()):
-                    if popped in deps:
-                        deps.remove(popped)
-                        if not deps:
-                            queue.append(thing)
-                            del draw_after[thing]
-
-            if draw_after:
-                # if the sorting couldn't fullfill all "draw after" contraints,
-                # we remove the ball / bone which lies farthest in the back
-                # and try again
-
-                least_evil = min((thing for thing in draw_after.keys()),
-                                 key = evilness
-                                )
-                sorted_things.append(least_evil)
-                del draw_after[least_evil]
-                for thing, deps in list(draw_after.items()):
-                    if least_evil in deps:
-                        deps.remove(least_evil)
-                        if not deps:
-                            queue.append(thing)
-                            del draw_after[thing]
-
-        self._things = sorted_things
+        """Projects all balls, including those in subfigures, in one go: their
+           centers are packed into one array and projected together."""
+        self.apply_transforms()
+        balls = list(self.ball_set())
+        if numpy is None or not balls:
+            for ball in balls:
+                ball.project(worldview)
+            return
+        centers = numpy.array([ball.center for ball in balls], float)
+        for ball, projection in zip(balls, worldview.project_points(centers).tolist()):
+            ball.projection = tuple(projection)
+
+    def sort(self, worldview, order = True):
+        """this assumes that projection has already happened! With order=False,
+           the things stay in their order and only the balls of each bone are
+           sorted, which decides how it's shaded; that's all that drawing
+           with a depth buffer needs."""
+        if order:
+            self._things = depth_order(self._things, worldview)
 
         for thing in self._things:
-            thing.sort(worldview)
-
-    def draw(self, image, worldview):
-        viewrect = Rect(*(tuple(-c for c in worldview.shift) + tuple(image.size - c for c in worldview.shift)))
+            thing.sort(worldview, order)
+
+    def draw(self, image, worldview, depth = None):
+        """Draws the things in their current order, so sort() should have been
+           called. Alternatively, pass a depth buffer (an image's
+           depth_buffer()) to have visibility decided pixel by pixel, with
+           no need for sort() at all: every ball and bone is drawn where its
+           front is closer than what's been drawn there already.
+
+           If the image is restricted to a band of rows (see set_band() in
+           graphics.py), things that can't reach into it are skipped."""
+        dx, dy = worldview.shift
+        top, bottom = image.band
+        viewrect = Rect(-dx, max(-dy, top - BOUNDING_SLACK - dy),
+                        image.size - dx, min(image.size - dy, bottom + BOUNDING_SLACK - dy))
         for thing in self._things:
             if thing.bounding().intersects(viewrect):
-                thing.draw(image, worldview)
+                if depth is not None and thing in self._hosts:
+                    thing.draw(image, worldview, depth = depth, host = self._hosts[thing])
+                else:
+                    thing.draw(image, worldview, depth = depth)
 
     def balls(self):
         for thing in self._things:
@@ -432,10 +634,115 @@ class Figure(object):
            exactly once."""
         return set(self.balls())
 
+    def rotate(self, angle, other, axis = 2):
+        """Rotates all balls that are in the figure right now around the ball
+           "other", like Ball.rotate(). Like scale(), this is only recorded and
+           done by apply_transforms()."""
+        self._check_enclosing(other)
+        m = rotation_matrix(angle, axis)
+        center = self._current_center(other)
+        offset = tuple(c - r[0] * center[0] - r[1] * center[1] - r[2] * center[2] for r, c in zip(m, center))
+        self._record((m, offset), 1)
+
     def scale(self, factor):
-        for ball in self.ball_set():
-            ball.radius *= factor
-            ball.center = tuple(c * factor for c in ball.center)
+        m = tuple(tuple(factor if i == j else 0. for j in range(3)) for i in range(3))
+        self._record((m, (0., 0., 0.)), factor)
+
+    def _record(self, affine, factor):
+        self._check_enclosing(*self.ball_set())
+        self._pending.append((len(self._things), affine, factor))
+        for ball in self.balls():
+            if ball._pending_in is None:
+                ball._pending_in = [self]
+            elif self not in ball._pending_in:
+                ball._pending_in.append(self)
+
+    def apply_transforms(self):
+        """Applies everything rotate() and scale() recorded (in subfigures,
+           too), combining it so that each ball is transformed only once.
+           project() calls this; until then, the balls' centers and radii
+           are the ones from before the recorded transforms, and
+           Ball.rotate() and Ball.set_distance() refuse to move them.
+
+           The transforms of a subfigure are applied before those of the
+           figure around it, so they have to be recorded first, too: once the
+           figure around it has transforms pending, rotate() and scale() of
+           the subfigure raise ValueError.
+
+           Only the transforms of whole figures are combined like this. The
+           pose functions in unicorn.py still bend each leg with Ball.rotate(),
+           one ball at a time (they run before the figure is rotated)."""
+        for thing in self._things:
+            if isinstance(thing, Figure):
+                thing.apply_transforms()
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+
+        # A transform applies to the balls of the things that were in the figure
+        # when it was recorded. Things are only ever appended, so a ball is
+        # affected by everything from the first transform recorded after its
+        # first thing was added on, i.e. by one of these combinations.
+        combined = [None] * len(pending)
+        affine, factor = IDENTITY, 1
+        for k in range(len(pending) - 1, -1, -1):
+            affine, factor = compose(affine, pending[k][1]), factor * pending[k][2]
+            combined[k] = affine, factor
+
+        counts = [count for count, affine, factor in pending]
+        for ball, index in self._first_things().items():
+            if ball._pending_in is not None and self in ball._pending_in:
+                ball._pending_in.remove(self)
+                if not ball._pending_in:
+                    ball._pending_in = None
+            k = bisect_right(counts, index)
+            if k < len(pending):
+                affine, factor = combined[k]
+                ball.center = transformed(affine, ball.center)
+                ball.radius *= factor
+
+    def _check_enclosing(self, *balls):
+        """apply_transforms() applies the transforms of subfigures before those
+           of the figure around them, so once a figure around this one has
+           transforms of the balls pending, recording more here would get the
+           order wrong."""
+        nested = set(self._nested())
+        for ball in balls:
+            for figure in ball._pending_in or ():
+                if figure is not self and figure not in nested:
+                    raise ValueError("Another figure has transforms of this ball pending; call its apply_transforms() first")
+
+    def _nested(self):
+        """Yields the subfigures, and theirs, and so on."""
+        for thing in self._things:
+            if isinstance(thing, Figure):
+                yield thing
+                for figure in thing._nested():
+                    yield figure
+
+    def _first_things(self):
+        """Maps every ball to the index of the first thing it's part of."""
+        first = {}
+        for index, thing in enumerate(self._things):
+            for ball in thing.balls():
+                first.setdefault(ball, index)
+        return first
+
+    def _current_center(self, ball, center = None):
+        """Where ball is with the pending transforms applied, those of the
+           subfigures first, like apply_transforms() does. Pass center to
+           start from there instead of from ball.center."""
+        if center is None:
+            center = ball.center
+        for thing in self._things:
+            if isinstance(thing, Figure) and ball in thing.ball_set():
+                center = thing._current_center(ball, center)
+        index = self._first_things().get(ball)
+        if index is not None:
+            for count, affine, factor in self._pending:
+                if count > index:
+                    center = transformed(affine, center)
+        return center
 
     def bounding(self):
         return sum((thing.bounding() for thing in self._things), None)
@@ -5,9 +5,9 @@ from sys import argv
 
 def unicorn_for_email(email):
     hash = hashlib.md5(email).hexdigest()
-    # Creates a BMP file of 256x256 pixels (see docstring of create_avatar)
-    f = open("%s.bmp" % email.decode('utf-8'), "wb")
-    f.write(create_avatar(128, int(hash, 16)))
+    # Creates a PNG file of 256x256 pixels (see docstring of create_avatar)
+    f = open("%s.png" % email.decode('utf-8'), "wb")
+    f.write(create_avatar(128, int(hash, 16), format = "png"))
     f.close()
 
 
@@ -23,12 +23,24 @@
 # install C libraries) I needed pure Python versions of the graphics
 # operations I need.
 
+from collections import Counter
 from colorsys import hls_to_rgb as hls_to_rgb_float
-from functools import partial
-from math import sqrt
+from functools import lru_cache
+from itertools import chain
+from math import sqrt, ceil, floor, isqrt
+import io
 import struct
+import sys
+import zlib
 
+try:
+    import numpy
+except ImportError:
+    # SquareImage doesn't need it; ArrayImage just won't be available
+    numpy = None
 
+
+@lru_cache(maxsize = 4096)
 def hls_to_rgb(h, l, s):
     rgb = hls_to_rgb_float(h / 360.0, l / 100.0, s / 100.0)
     return tuple(int(255 * v) for v in rgb)
@@ -38,10 +50,415 @@ def blend(color1, color2, factor):
     return tuple(c1 + int((c2 - c1) * factor) for c1, c2 in zip(color1, color2))
 
 
+@lru_cache(maxsize = 2048)
+def circle_spans(radius):
+    """Returns the half widths of the horizontal lines that make up a circle
+       of the given (integer) radius, from the top row to the bottom row, i.e.
+       index i is the line at y = center - radius + i. The first radius + 1
+       entries are the top half.
+
+       The tables are shared by all images in the process, and since the
+       radii of the circles in Bone.draw() only differ by fractions of a
+       pixel, most circles are drawn from a table that already exists."""
+
+    # adapted from http://en.wikipedia.org/wiki/Midpoint_circle_algorithm
+    # The algorithm may draw the same line more than once; since all lines
+    # are centered, keeping the widest one gives the same pixels.
+    widths = [0] * (2 * radius + 1)
+    widths[radius] = radius
+
+    f = 1 - radius
+    ddF_x = 1
+    ddF_y = -2 * radius
+    x = 0
+    y = radius
+
+    while x < y:
+        if f >= 0:
+            y -= 1
+            ddF_y += 2
+            f += ddF_y
+        x += 1
+        ddF_x += 2
+        f += ddF_x
+
+        for dy, w in ((y, x), (x, y)):
+            widths[radius + dy] = max(widths[radius + dy], w)
+            widths[radius - dy] = max(widths[radius - dy], w)
+
+    return tuple(widths)
+
+
+@lru_cache(maxsize = 1024)
+def color_ramp(color1, color2, pixel):
+    """The 256 colors from color1 to color2 that connect_circles() uses,
+       each converted with pixel (see SquareImage._pixel())."""
+    return tuple(pixel(tuple(int(v[0] + fac * (v[1] - v[0]) / 255) for v in zip(color1, color2))) for fac in range(256))
+
+
+def capsule_extents(center1, radius1, center2, radius2, ymin, ymax):
+    """Returns a list with one entry for each row from ymin to ymax: the
+       (left, right) extent of the convex hull of the two circles in that
+       row, or None if the row misses it. The hull's outline consists of an
+       arc of each circle and the two outer tangents, so each extent is the
+       outermost of at most four intersections."""
+    (x1, y1), (x2, y2) = center1, center2
+    vx, vy = x2 - x1, y2 - y1
+    length = sqrt(vx**2 + vy**2)
+    d = radius2 - radius1
+
+    tangents = []
+    if length > abs(d):
+        # n is the unit normal of a tangent, pointing outwards: n.v = -d
+        ux, uy = vx / length, vy / length
+        along = -d / length
+        across = sqrt(1 - along**2)
+        for sign in (-1, 1):
+            nx = along * ux - sign * across * uy
+            ny = along * uy + sign * across * ux
+            tangents.append((x1 + radius1 * nx, y1 + radius1 * ny, x2 + radius2 * nx, y2 + radius2 * ny))
+
+    extents = []
+    for y in range(ymin, ymax + 1):
+        xs = []
+        for (cx, cy), r in ((center1, radius1), (center2, radius2)):
+            h = r**2 - (y - cy)**2
+            if h >= 0:
+                h = sqrt(h)
+                xs.append(cx - h)
+                xs.append(cx + h)
+        for ax, ay, bx, by in tangents:
+            if ay == by:
+                if y == ay:
+                    xs.append(ax)
+                    xs.append(bx)
+            elif (y - ay) * (y - by) <= 0:
+                xs.append(ax + (y - ay) / (by - ay) * (bx - ax))
+        extents.append((min(xs), max(xs)) if xs else None)
+    return extents
+
+
+def line_extents(size, x0, widths):
+    """Does hor_line()'s clipping for lines of the given half widths (a numpy
+       array) centered at x0 on an image of the given size. Returns arrays of
+       the first and one-past-last x; lines that hor_line() wouldn't draw
+       at all, or with a negative width, become empty (0, 0)."""
+    s = size - 1
+    left = x0 - widths
+    right = x0 + widths
+    drawn = (widths >= 0) & (left <= s) & (right >= 0)
+    xa = numpy.where(drawn, numpy.maximum(0, numpy.trunc(left)), 0).astype(numpy.int64)
+    xb = numpy.where(drawn, numpy.minimum(s, numpy.trunc(right)) + 1, 0).astype(numpy.int64)
+    return xa, xb
+
+
+@lru_cache(maxsize = 2048)
+def _span_array(radius):
+    """circle_spans() as a numpy array."""
+    return numpy.array(circle_spans(radius))
+
+
+def circle_lines(size, center, radius, top_half = False):
+    """Returns the lines that circle() (or top_half_circle()) would draw on an
+       image of the given size, as numpy arrays of rows, first x and
+       one-past-last x. Needs numpy."""
+    radius = int(radius)
+    x0, y0 = center
+    s = size - 1
+    if radius < 0 or x0 < -radius or y0 < -radius or x0 - radius > size or y0 - radius > size:
+        empty = numpy.zeros(0, numpy.int64)
+        return empty, empty, empty
+
+    widths = numpy.array(circle_spans(radius)[:radius + 1 if top_half else None])
+    y = y0 + (numpy.arange(len(widths)) - radius)
+    inside = (y >= 0) & (y <= s)
+    xa, xb = line_extents(size, x0, widths[inside])
+    return numpy.trunc(y[inside] + .5).astype(numpy.int64), xa, xb
+
+
+def warm_span_tables(max_radius):
+    """Builds the circle_spans() tables for all radii up to max_radius ahead of time."""
+    for radius in range(max_radius + 1):
+        circle_spans(radius)
+
+# The radius of a ball is at most 60 or so in unicorn units; this covers
+# most of what is drawn at sizes up to 128.
+warm_span_tables(128)
+
+
+def _lanes(row):
+    """Returns the bytes of row as one big integer with 16 bits per byte."""
+    wide = bytearray(2 * len(row))
+    wide[0::2] = row
+    return int.from_bytes(wide, "little")
+
+
+def reduce_rows(rows, width):
+    """Takes RGB scanlines (3 * width bytes each) of an image and yields the
+       scanlines of the image with half the width and height, where each
+       pixel is the (rounded) average of a 2x2 block.
+
+       This works on two whole rows at a time: the bytes are spread out into
+       16 bit lanes of a big integer, so that one addition adds up all pixels
+       of the rows, and shifting by three lanes brings the right neighbor of
+       each pixel on top of it. No lane ever exceeds 1022, so nothing carries
+       over into the next one."""
+    half = width // 2
+    length = 6 * half
+    rounding = _lanes(b"\2" * length)
+    rows = iter(rows)
+    for upper in rows:
+        lower = next(rows, None)
+        if lower is None:
+            return
+        total = _lanes(upper[:length]) + _lanes(lower[:length])
+        total = (total + (total >> 48) + rounding) >> 2
+        low_bytes = total.to_bytes(2 * length + 2, "little")[0:2 * length:2]
+        out = bytearray(3 * half)
+        out[0::3] = low_bytes[0::6]
+        out[1::3] = low_bytes[1::6]
+        out[2::3] = low_bytes[2::6]
+        yield bytes(out)
+
+
+def _png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def _compressed_rows(rows, width, level):
+    """Compresses PNG scanlines and yields the data in pieces of about 64 KB,
+       one IDAT (or fdAT) chunk each. A scanline that is identical to the
+       one above it (which is common in these images) is sent with the "up"
+       filter, i.e. as zeros; everything else is sent unfiltered."""
+    compressor = zlib.compressobj(level)
+    up_zeros = b"\2" + b"\0" * (3 * width)
+    pending = []
+    pending_size = 0
+    previous = None
+    for row in rows:
+        if row == previous:
+            data = compressor.compress(up_zeros)
+        else:
+            data = compressor.compress(b"\0" + row)
+        previous = row
+        if data:
+            pending.append(data)
+            pending_size += len(data)
+            if pending_size >= 65536:
+                yield b"".join(pending)
+                pending = []
+                pending_size = 0
+    pending.append(compressor.flush())
+    yield b"".join(pending)
+
+
+def write_png(file, width, height, rows, level = 6):
+    """Writes an 8 bit RGB PNG to the file-like object file. rows must yield
+       the height scanlines top to bottom, each as 3 * width bytes.
+
+       Each scanline goes through the compressor as soon as it's produced, and
+       the compressed data is written in IDAT chunks of about 64 KB, so the
+       whole file never has to be in memory."""
+
+    file.write(b"\x89PNG\r\n\x1a\n")
+    file.write(_png_chunk(b"IHDR", struct.pack(">2I5B", width, height, 8, 2, 0, 0, 0)))
+    for data in _compressed_rows(rows, width, level):
+        file.write(_png_chunk(b"IDAT", data))
+    file.write(_png_chunk(b"IEND", b""))
+
+
+def write_apng(file, width, height, frames, level = 6, loops = 0):
+    """Writes an animated PNG. frames is a list of (left, top, width, height,
+       delay, rows) tuples, delay in milliseconds and rows like for
+       write_png(); each frame replaces the given rectangle of the previous
+       one, so after the first (which has to cover the whole image) a frame
+       only needs to contain what changed. loops = 0 means forever.
+
+       Viewers that don't know APNG show the first frame."""
+
+    file.write(b"\x89PNG\r\n\x1a\n")
+    file.write(_png_chunk(b"IHDR", struct.pack(">2I5B", width, height, 8, 2, 0, 0, 0)))
+    file.write(_png_chunk(b"acTL", struct.pack(">2I", len(frames), loops)))
+    sequence = 0
+    for index, (left, top, frame_width, frame_height, delay, rows) in enumerate(frames):
+        # dispose op 0 (leave the frame as it is), blend op 0 (replace)
+        file.write(_png_chunk(b"fcTL", struct.pack(">5I2H2B", sequence, frame_width, frame_height,
+                                                   left, top, delay, 1000, 0, 0)))
+        sequence += 1
+        for data in _compressed_rows(rows, frame_width, level):
+            if index == 0:
+                file.write(_png_chunk(b"IDAT", data))
+            else:
+                file.write(_png_chunk(b"fdAT", struct.pack(">I", sequence) + data))
+                sequence += 1
+    file.write(_png_chunk(b"IEND", b""))
+
+
+def color_counts(rows, counts = None):
+    """Counts the colors in RGB scanlines (as in write_png()); returns a
+       Counter mapping (r, g, b) tuples to the number of pixels. Pass counts
+       to add to an existing Counter."""
+    if counts is None:
+        counts = Counter()
+    for row in rows:
+        counts.update(zip(row[0::3], row[1::3], row[2::3]))
+    return counts
+
+
+def median_cut(counts, colors = 256):
+    """Finds a palette of at most colors colors for an image with the given
+       color_counts(): starting with all colors in one box, the box with the
+       most pixels times the widest channel range is split at the (pixel
+       weighted) median of that channel, until there are enough boxes. Each
+       box becomes the average of its pixels. Returns the palette and a dict
+       mapping every color to its palette index."""
+    def widest(box):
+        ranges = [max(values) - min(values) for values in zip(*box)]
+        channel = max(range(3), key = ranges.__getitem__)
+        return sum(map(counts.__getitem__, box)) * ranges[channel], channel
+
+    boxes = [list(counts)]
+    priorities = [widest(boxes[0])]
+    while len(boxes) < colors:
+        i = max(range(len(boxes)), key = lambda i: priorities[i][0])
+        priority, channel = priorities[i]
+        if priority == 0:
+            break
+        box = sorted(boxes[i], key = lambda color: color[channel])
+        half = sum(counts[color] for color in box) / 2.
+        total = 0
+        for split in range(1, len(box)):
+            total += counts[box[split - 1]]
+            if total >= half:
+                break
+        # both halves have to keep at least one color
+        boxes[i:i + 1] = box[:split], box[split:]
+        priorities[i:i + 1] = widest(box[:split]), widest(box[split:])
+
+    palette = []
+    mapping = {}
+    for box in boxes:
+        pixels = sum(counts[color] for color in box)
+        palette.append(tuple(int(sum(color[c] * counts[color] for color in box) / pixels + .5) for c in range(3)))
+        for color in box:
+            mapping[color] = len(palette) - 1
+    return palette, mapping
+
+
+def gif_palette(counts):
+    """Returns a palette of at most 256 colors and a dict that maps each color
+       in counts to its index. That's just the colors in counts if there
+       aren't too many of them, otherwise see median_cut()."""
+    if len(counts) > 256:
+        return median_cut(counts, 256)
+    palette = sorted(counts)
+    return palette, dict((color, i) for i, color in enumerate(palette))
+
+
+def index_rows(rows, mapping):
+    """Turns RGB scanlines into rows of palette indices, one byte per pixel."""
+    lookup = mapping.__getitem__
+    for row in rows:
+        yield bytes(map(lookup, zip(row[0::3], row[1::3], row[2::3])))
+
+
+def _lzw_blocks(rows, min_code_size):
+    """LZW-codes rows of palette indices the way GIF wants them, yielding
+       the data sub-blocks (a length byte and up to 255 bytes) as soon as
+       they're full. The code size grows and the table is cleared at the
+       same points where giflib's encoder does it."""
+    clear = 1 << min_code_size
+    end = clear + 1
+    size = min_code_size + 1
+    next_code = end + 1
+    table = {}
+    out = bytearray()
+    # bits not yet in out, lowest first
+    pending, pending_bits = clear, size
+    prefix = None
+    for row in rows:
+        for index in row:
+            if prefix is None:
+                prefix = index
+                continue
+            key = prefix << 8 | index
+            code = table.get(key)
+            if code is not None:
+                prefix = code
+                continue
+
+            pending |= prefix << pending_bits
+            pending_bits += size
+            if next_code >= 1 << size and size < 12:
+                size += 1
+            if next_code >= 4095:
+                pending |= clear << pending_bits
+                pending_bits += size
+                table.clear()
+                next_code = end + 1
+                size = min_code_size + 1
+            else:
+                table[key] = next_code
+                next_code += 1
+            prefix = index
+
+            while pending_bits >= 8:
+                out.append(pending & 255)
+                pending >>= 8
+                pending_bits -= 8
+            if len(out) >= 255:
+                yield b"\xff" + out[:255]
+                del out[:255]
+
+    if prefix is not None:
+        pending |= prefix << pending_bits
+        pending_bits += size
+        if next_code >= 1 << size and size < 12:
+            size += 1
+    pending |= end << pending_bits
+    pending_bits += size
+    out += pending.to_bytes((pending_bits + 7) // 8, "little")
+    for start in range(0, len(out), 255):
+        block = out[start:start + 255]
+        yield bytes((len(block),)) + block
+
+
+def write_gif(file, width, height, frames, palette, loops = 0):
+    """Writes a GIF to the file-like object file. palette is a list of at
+       most 256 (r, g, b) colors; frames is a list of (left, top, width,
+       height, delay, rows) tuples like for write_apng(), except that rows
+       must yield rows of palette indices (see index_rows()). Each frame is
+       LZW-coded and written while its rows are produced. With more than one
+       frame, the GIF is an animation that's repeated loops times, 0 meaning
+       forever; GIF delays are in hundredths of a second, so the ones given
+       in milliseconds are rounded."""
+    bits = max(1, (len(palette) - 1).bit_length())
+    colors = bytes(chain.from_iterable(palette)).ljust(3 << bits, b"\0")
+    file.write(b"GIF89a" + struct.pack("<2H3B", width, height, 0x80 | (bits - 1), 0, 0) + colors)
+    animated = len(frames) > 1
+    if animated:
+        file.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loops) + b"\0")
+    min_code_size = max(2, bits)
+    for left, top, frame_width, frame_height, delay, rows in frames:
+        if animated:
+            # disposal method 1: the next frame is drawn on top of this one
+            file.write(b"\x21\xf9\x04" + struct.pack("<BH2B", 1 << 2, (delay + 5) // 10, 0, 0))
+        file.write(b"\x2c" + struct.pack("<4HB", left, top, frame_width, frame_height, 0))
+        file.write(bytes((min_code_size,)))
+        for block in _lzw_blocks(rows, min_code_size):
+            file.write(block)
+        file.write(b"\0")
+    file.write(b"\x3b")
+
+
 class SquareImage(object):
 
     RESTORE = -1
 
+    # drawing only touches the rows _top to _bottom, see set_band()
+    _top = 0
+    _bottom = sys.maxsize
+
     @classmethod
     def plain(cls, size, color):
         self = object.__new__(cls)
@@ -50,6 +467,21 @@ class SquareImage(object):
         self.s = size - 1
         return self
 
+    @classmethod
+    def plain_band(cls, size, color, top, bottom):
+        """Like plain(), but restricted to the rows top to bottom (see
+           set_band()), and only those rows are filled in; the others may
+           not even exist. So it's good for drawing a band and taking its
+           rows with _region_rows(), but nothing else."""
+        self = object.__new__(cls)
+        self.size = size
+        self.s = size - 1
+        self.set_band(top, bottom)
+        self._image = [None] * size
+        for y in range(self._top, self._bottom + 1):
+            self._image[y] = [color] * size
+        return self
+
     def __init__(self, size, top_color, bottom_color):
         delta = [b - t for b, t in zip(bottom_color, top_color)]
         s = size - 1
@@ -59,17 +491,68 @@ class SquareImage(object):
         self.size = size
         self.s = s
 
-    def save(self):
-        self._saved = [[p for p in l] for l in self._image]
+    def save(self, top = 0, bottom = None):
+        """Remembers the rows top to bottom (inclusive; by default the whole
+           image), so they can be brought back with restore_hor_line() or by
+           drawing with the color RESTORE. Only restore rows that were saved."""
+        if bottom is None:
+            bottom = self.s
+        self._saved = dict((y, list(self._image[y])) for y in range(max(0, top), min(self.s, bottom) + 1))
+
+    def set_band(self, top, bottom):
+        """Restricts all drawing to the rows top to bottom (inclusive). Things
+           are drawn exactly as on the whole image, but only the pixels in
+           those rows are set; the others are left alone. So an image can be
+           drawn in horizontal bands, each on an image of its own, and put
+           together from their rows."""
+        self._top = max(0, top)
+        self._bottom = min(self.s, bottom)
+
+    @property
+    def band(self):
+        """The first and last row that set_band() restricts drawing to."""
+        return self._top, min(self.s, self._bottom)
+
+    def copy(self):
+        """Returns a new image of the same class with the same pixels (but
+           nothing saved, and no band)."""
+        other = object.__new__(type(self))
+        other._image = [list(row) for row in self._image]
+        other.size = self.size
+        other.s = self.s
+        return other
+
+    def copy_rows(self, source, top, bottom):
+        """Overwrites the rows top to bottom (inclusive) with those of source,
+           which must be an image of the same class and size."""
+        for y in range(max(self._top, top), min(self.s, self._bottom, bottom) + 1):
+            self._image[y] = list(source._image[y])
+
+    def copy_rect(self, source, left, top, right, bottom):
+        """Overwrites the pixels from (left, top) to (right, bottom), inclusive,
+           with those of source, which must be an image of the same class and
+           size."""
+        left, right = max(0, left), min(self.s, right)
+        for y in range(max(self._top, top), min(self.s, self._bottom, bottom) + 1):
+            self._image[y][left:right + 1] = source._image[y][left:right + 1]
+
+    @property
+    def nbytes(self):
+        """Roughly the memory the pixels take: one reference per pixel, the
+           color tuples themselves are shared."""
+        return 8 * self.size * self.size
 
     def hor_line(self, color, x0, x1, y):
         """x0 must be <= x1 """
         s = self.s
         if y < 0 or y > s or x0 > s or x1 < 0:
             return
+        yr = int(y+.5)
+        if yr < self._top or yr > self._bottom:
+            return
         x0 = max(0, int(x0))
         x1 = min(s, int(x1)) + 1
-        self._image[int(y+.5)][x0:x1] = [color] * (x1 - x0)
+        self._image[yr][x0:x1] = [color] * (x1 - x0)
 
     def hor_gradient(self, color1, color2, x0, x1, y0, y1):
         s = self.s
@@ -85,7 +568,7 @@ class SquareImage(object):
         x0 = max(0, int(x0))
         x1 = min(s, int(x1)) + 1
         line = [blend(color1, color2, (x - x0) / float(x1 - x0)) for x in range(x0, x1)]
-        for y in range(int(y0 + .5), int(y1 + 1.5)):
+        for y in range(max(self._top, int(y0 + .5)), min(self._bottom, int(y1 + .5)) + 1):
             self._image[y][x0:x1] = line
 
     def restore_hor_line(self, x0, x1, y):
@@ -93,46 +576,117 @@ class SquareImage(object):
         s = self.s
         if y < 0 or y > s or x0 > s or x1 < 0:
             return
+        yr = int(y+.5)
+        if yr < self._top or yr > self._bottom:
+            return
         x0 = max(0, int(x0))
         x1 = min(s, int(x1)) + 1
-        yr = int(y+.5)
         self._image[yr][x0:x1] = self._saved[yr][x0:x1]
 
     def circle(self, center, radius, color):
-        # adapted from http://en.wikipedia.org/wiki/Midpoint_circle_algorithm
+        radius = int(radius)
+        x0, y0 = center
 
+        if radius < 0 or x0 < -radius or y0 < -radius or x0 - radius > self.size or y0 - radius > self.size:
+            return
+
+        self._draw_spans(circle_spans(radius), radius, 2 * radius + 1, x0, y0, color)
+
+    def top_half_circle(self, center, radius, color):
         radius = int(radius)
         x0, y0 = center
 
-        if x0 < -radius or y0 < -radius or x0 - radius > self.size or y0 - radius > self.size:
+        if radius < 0 or x0 < -radius or y0 < -radius or x0 - radius > self.size or y0 - radius > self.size:
             return
 
-        f = 1 - radius
-        ddF_x = 1
-        ddF_y = -2 * radius
-        x = 0
-        y = radius
+        self._draw_spans(circle_spans(radius), radius, radius + 1, x0, y0, color)
 
-        if color == self.RESTORE:
-            hl = self.restore_hor_line
-        else:
-            hl = partial(self.hor_line, color)
+    def _draw_spans(self, spans, radius, count, x0, y0, color):
+        """Draws the first count lines of the circle_spans() table spans, centered
+           at (x0, y0). Each line is clipped like in hor_line(); the rows outside
+           of the image aren't even looked at."""
+        s = self.s
+        first = max(0, int(ceil(radius - y0)))
+        last = min(count, int(floor(s - y0 + radius)) + 1)
+        top, bottom = self._top, self._bottom
+
+        image = self._image
+        restore = color == self.RESTORE
+        if restore:
+            saved = self._saved
+        for i in range(first, last):
+            y = int(y0 + (i - radius) + .5)
+            if y < top or y > bottom:
+                continue
+            w = spans[i]
+            left = x0 - w
+            right = x0 + w
+            if left > s or right < 0:
+                continue
+            xa = max(0, int(left))
+            xb = min(s, int(right)) + 1
+            if restore:
+                image[y][xa:xb] = saved[y][xa:xb]
+            else:
+                image[y][xa:xb] = [color] * (xb - xa)
+
+    def annuli(self, center, radii, colors):
+        """Has the same result as calling circle(center, radius, color) for
+           each pair of radii and colors in turn, where a color of None stands
+           for RESTORE with the image saved right before the first circle.
+           But instead of overdrawing, each ring between one circle and the
+           circles drawn after it is drawn once, and the pixels of a None ring
+           are just left alone, so nothing has to be saved."""
+        x0, y0 = center
+        s = self.s
+        circles = []
+        for radius, color in zip(radii, colors):
+            radius = int(radius)
+            if radius < 0 or x0 < -radius or y0 < -radius or x0 - radius > self.size or y0 - radius > self.size:
+                continue  # circle() wouldn't draw anything either
+            circles.append((radius, circle_spans(radius), color))
+        if not circles:
+            return
+        circles.reverse()
 
-        hl(x0 - radius, x0 + radius, y0)
+        def extent(w):
+            left = x0 - w
+            right = x0 + w
+            if left > s or right < 0:
+                return None
+            return max(0, int(left)), min(s, int(right)) + 1
 
-        while x < y:
-            if f >= 0:
-                y -= 1
-                ddF_y += 2
-                f += ddF_y
-            x += 1
-            ddF_x += 2
-            f += ddF_x
+        outer = max(radius for radius, spans, color in circles)
+        for dy in range(max(-outer, int(ceil(-y0))), min(outer, int(floor(s - y0))) + 1):
+            y = int(y0 + dy + .5)
+            if y < self._top or y > self._bottom:
+                continue
+            # all lines in this row are centered at x0, so the part of this
+            # row that is covered by the circles drawn after a given one is
+            # just the line of the widest of them
+            covered = None
+            for radius, spans, color in circles:
+                if abs(dy) > radius:
+                    continue
+                w = spans[radius + dy]
+                if covered is not None and w <= covered:
+                    continue
+                if color is not None:
+                    line = extent(w)
+                    inner = extent(covered) if covered is not None else None
+                    if line is not None:
+                        if inner is None:
+                            self._fill(color, y, *line)
+                        else:
+                            if line[0] < inner[0]:
+                                self._fill(color, y, line[0], inner[0])
+                            if inner[1] < line[1]:
+                                self._fill(color, y, inner[1], line[1])
+                covered = w
 
-            hl(x0 - x, x0 + x, y0 + y)
-            hl(x0 - x, x0 + x, y0 - y)
-            hl(x0 - y, x0 + y, y0 + x)
-            hl(x0 - y, x0 + y, y0 - x)
+    def _fill(self, color, y, x0, x1):
+        """Sets the pixels x0 <= x < x1 of row y; there is no clipping."""
+        self._image[y][x0:x1] = [color] * (x1 - x0)
 
     def connect_circles(self, center1, radius1, color1, center2, radius2, color2):
         # see Bone.draw() in core.py for some notes on performance of this algorithm
@@ -141,10 +695,11 @@ class SquareImage(object):
         radius1, radius2 = int(radius1), int(radius2)
         xmin = int(max(0, min(center1[0] - radius1, center2[0] - radius2)))
         xmax = int(min(self.s, max(center1[0] + radius1, center2[0] + radius2)))
-        ymin = int(max(0, min(center1[1] - radius1, center2[1] - radius2)))
-        ymax = int(min(self.s, max(center1[1] + radius1, center2[1] + radius2)))
+        ymin = int(max(self._top, min(center1[1] - radius1, center2[1] - radius2)))
+        ymax = int(min(self.s, self._bottom, max(center1[1] + radius1, center2[1] + radius2)))
 
-        col = [tuple(int(v[0] + fac * (v[1] - v[0]) / 255) for v in zip(color1, color2)) for fac in range(256)]
+        col = color_ramp(tuple(color1), tuple(color2), self._pixel)
+        rgb2 = color_ramp(tuple(color1), tuple(color2), tuple)[255]
 
         d = radius2 - radius1
         vx = center2[0] - center1[0]
@@ -153,88 +708,787 @@ class SquareImage(object):
         r1d = radius1 * d
         r1s = radius1 ** 2
         c2x = center2[0]
-        d2xs = dict((x, (x - c2x)**2) for x in range(xmin, xmax + 1))
 
-        for y in range(ymin, ymax + 1):
-            line = self._image[y]
+        # Only the pixels within (a pixel of) the row's analytic extent are
+        # looked at; those are exactly the ones the tests below can accept.
+        extents = capsule_extents(center1, radius1, center2, radius2, ymin, ymax)
+
+        for y, extent in zip(range(ymin, ymax + 1), extents):
+            if extent is None:
+                continue
             dy = y - center1[1]
             b_ = vy * dy + r1d
             c_ = dy**2 - r1s
             r2sdy2s = radius2**2 - (y - center2[1])**2
-            for x in range(xmin, xmax + 1):
+            xa = max(xmin, int(floor(extent[0])) - 1)
+            xb = min(xmax, int(ceil(extent[1])) + 1) + 1
+
+            # The pixels with (x - c2x)**2 < r2sdy2s, i.e. inside the second
+            # circle, all get its color; they're one run, filled in one go.
+            inner = isqrt(r2sdy2s - 1) if r2sdy2s > 0 else -1
+            inner_a = max(xa, c2x - inner)
+            inner_b = min(xb, c2x + inner + 1)
+            if inner_a < inner_b:
+                self._fill(rgb2, y, inner_a, inner_b)
+                xs = chain(range(xa, inner_a), range(inner_b, xb))
+            else:
+                xs = range(xa, xb)
+
+            # consecutive accepted pixels are collected and written as one run
+            run = []
+            end = None
+            for x in xs:
                 dx = x - center1[0]
 
                 b = -2 *(vx * dx + b_)
                 c = dx**2 + c_
 
-                if d2xs[x] < r2sdy2s:
-                    l = 1
-                elif a == 0:
-                    if b == 0:
-                        continue
-                    l = -c / float(b)
+                if a == 0:
+                    l = -c / float(b) if b != 0 else None
                 else:
                     p = b / a
                     q = c / a
                     disc = p**2 / 4 - q
                     if disc < 0:
-                        continue
-                    sqrtdisc = sqrt(disc)
-                    l = -p / 2 + sqrtdisc
-                    if l > 1:
-                        l = -p / 2 - sqrtdisc
-                if l > 1:
-                    continue
-                    if (x - center2[0])**2 + (y - center2[1])**2 > radius2**2:
-                        continue
-                    else:
-                        l = 1
-                if l < 0:
-                    if c > 0:
-                        continue
+                        l = None
                     else:
-                        l = 0
-                line[x] = col[int(l * 255)]
+                        sqrtdisc = sqrt(disc)
+                        l = -p / 2 + sqrtdisc
+                        if l > 1:
+                            l = -p / 2 - sqrtdisc
+                if l is None or l > 1 or (l < 0 and c > 0):
+                    continue
+                if x != end:
+                    if run:
+                        self._put(y, start, run)
+                    run = []
+                    start = x
+                run.append(col[int(l * 255)] if l > 0 else col[0])
+                end = x + 1
+            if run:
+                self._put(y, start, run)
 
-    def top_half_circle(self, center, radius, color):
-        # This is just copy & paste from circle() with
-        # two lines removed. I've heard this is called "code reuse".
+    def _put(self, y, x, pixels):
+        """Sets the pixels of row y starting at x to the given _pixel() values."""
+        self._image[y][x:x + len(pixels)] = pixels
 
-        radius = int(radius)
-        x0, y0 = center
-        if x0 < -radius or y0 < -radius or x0 - radius > self.size or y0 - radius > self.size:
-            return
-        f = 1 - radius
-        ddF_x = 1
-        ddF_y = -2 * radius
-        x = 0
-        y = radius
-        if color == self.RESTORE:
-            hl = self.restore_hor_line
-        else:
-            hl = partial(self.hor_line, color)
-        hl(x0 - radius, x0 + radius, y0)
-        while x < y:
-            if f >= 0:
-                y -= 1
-                ddF_y += 2
-                f += ddF_y
-            x += 1
-            ddF_x += 2
-            f += ddF_x
-            hl(x0 - x, x0 + x, y0 - y)
-            hl(x0 - y, x0 + y, y0 - x)
+    @staticmethod
+    def _pixel(color):
+        """Converts an RGB tuple into what is stored per pixel."""
+        return color
 
-    def to_bmp(self):
+    def _rgb_rows(self):
+        """Yields the rows top to bottom, each as 3 * size bytes R, G, B."""
+        for line in self._image:
+            yield bytes(chain.from_iterable(line))
+
+    def _region_rows(self, left, top, right, bottom):
+        """Like _rgb_rows(), but only the rows top to bottom, and of those only
+           the pixels left to right (inclusive)."""
+        for line in self._image[top:bottom + 1]:
+            yield bytes(chain.from_iterable(line[left:right + 1]))
+
+    @classmethod
+    def from_rgb_rows(cls, size, rows):
+        """Creates an image from rows as returned by _rgb_rows()."""
+        self = object.__new__(cls)
+        self._image = [list(zip(row[0::3], row[1::3], row[2::3])) for row in rows]
+        self.size = size
+        self.s = size - 1
+        return self
+
+    def downsampled(self):
+        """Returns a new image of the same class and half the size, in which
+           each pixel is the average of a 2x2 block of this image. This is
+           the antialiasing step that create_avatar() leaves to the caller
+           by default."""
+        return self.from_rgb_rows(self.size // 2, reduce_rows(self._rgb_rows(), self.size))
+
+    def to_png(self, level = 6, file = None):
+        """Encodes the image as PNG with the given zlib compression level. If
+           file is given, the PNG is written to it as it's being compressed;
+           otherwise it is returned."""
+        if file is not None:
+            write_png(file, self.size, self.size, self._rgb_rows(), level)
+            return
+        out = io.BytesIO()
+        write_png(out, self.size, self.size, self._rgb_rows(), level)
+        return out.getvalue()
+
+    def to_gif(self, file = None):
+        """Encodes the image as GIF, with an exact palette if it has no more
+           than 256 colors (see gif_palette()). This goes over the pixels
+           twice, once to count the colors and once to encode them, so the
+           indexed image is never in memory as a whole. Like to_png(), it
+           writes to file if given and returns the GIF otherwise."""
+        palette, mapping = gif_palette(color_counts(self._rgb_rows()))
+        frames = [(0, 0, self.size, self.size, 0, index_rows(self._rgb_rows(), mapping))]
+        if file is not None:
+            write_gif(file, self.size, self.size, frames, palette)
+            return
+        out = io.BytesIO()
+        write_gif(out, self.size, self.size, frames, palette)
+        return out.getvalue()
+
+    def _bmp_header(self):
+        """Returns the 54 bytes that precede the pixel data, and the number
+           of padding bytes at the end of each scanline."""
         padding = 4 - (3 * self.size) % 4
         if padding == 4:
             padding = 0
         bitmap_data_size = (3 * self.size + padding) * self.size
         total_size = bitmap_data_size + 54
+        header = struct.pack("<2s6I2H6I", b"BM", total_size, 0, 54, 40, self.size, self.size, 1, 24, 0, bitmap_data_size, 2835, 2835, 0, 0)
+        return header, padding
+
+    def to_bmp(self):
+        header, padding = self._bmp_header()
 
         scanline_struct = struct.Struct("%dB%dx" % (3 * self.size, padding))
         def data_iterator():
-            yield struct.pack("<2s6I2H6I", b"BM", total_size, 0, 54, 40, self.size, self.size, 1, 24, 0, bitmap_data_size, 2835, 2835, 0, 0)
+            yield header
             for line in reversed(self._image):
                 yield scanline_struct.pack(*(val for col in line for val in reversed(col)))
         return b"".join(data_iterator())
+
+
+class ArrayImage(SquareImage):
+    """Same interface as SquareImage, but the pixels live in one contiguous
+       size x size x 3 numpy array, so a horizontal line is a single slice
+       assignment instead of building a list of tuples. Only available
+       if numpy can be imported.
+
+       circle() and top_half_circle() are inherited; they only go through
+       _draw_spans(), which is overridden."""
+
+    @classmethod
+    def plain(cls, size, color):
+        self = object.__new__(cls)
+        self._image = numpy.empty((size, size, 3), numpy.uint8)
+        self._image[:] = color
+        self.size = size
+        self.s = size - 1
+        return self
+
+    @classmethod
+    def plain_band(cls, size, color, top, bottom):
+        self = object.__new__(cls)
+        self.size = size
+        self.s = size - 1
+        self.set_band(top, bottom)
+        # the memory of the rows that are never written isn't even touched
+        self._image = numpy.zeros((size, size, 3), numpy.uint8)
+        self._image[self._top:self._bottom + 1] = color
+        return self
+
+    def __init__(self, size, top_color, bottom_color):
+        top = numpy.array(top_color, numpy.int64)
+        delta = numpy.array(bottom_color, numpy.int64) - top
+        s = size - 1
+        # same integer arithmetic as SquareImage, so the gradient is identical
+        column = top + numpy.arange(size)[:, None] * delta // s
+        self._image = numpy.empty((size, size, 3), numpy.uint8)
+        self._image[:] = column[:, None, :]
+        self.size = size
+        self.s = s
+
+    def save(self, top = 0, bottom = None):
+        if bottom is None:
+            bottom = self.s
+        self._saved = dict((y, self._image[y].copy()) for y in range(max(0, top), min(self.s, bottom) + 1))
+
+    def copy(self):
+        other = object.__new__(type(self))
+        other._image = self._image.copy()
+        other.size = self.size
+        other.s = self.s
+        return other
+
+    def copy_rows(self, source, top, bottom):
+        top, bottom = max(self._top, top), min(self.s, self._bottom, bottom)
+        if top > bottom:
+            return
+        self._image[top:bottom + 1] = source._image[top:bottom + 1]
+
+    def copy_rect(self, source, left, top, right, bottom):
+        top, left = max(self._top, top), max(0, left)
+        bottom = min(self._bottom, bottom)
+        if top > bottom:
+            return
+        self._image[top:bottom + 1, left:right + 1] = source._image[top:bottom + 1, left:right + 1]
+
+    @property
+    def nbytes(self):
+        return self._image.nbytes
+
+    def hor_line(self, color, x0, x1, y):
+        """x0 must be <= x1 """
+        s = self.s
+        if y < 0 or y > s or x0 > s or x1 < 0:
+            return
+        yr = int(y+.5)
+        if yr < self._top or yr > self._bottom:
+            return
+        self._image[yr, max(0, int(x0)):min(s, int(x1)) + 1] = color
+
+    def hor_gradient(self, color1, color2, x0, x1, y0, y1):
+        s = self.s
+        if y1 < 0 or y0 > s or x0 > s or x1 < 0:
+            return
+
+        if x0 < 0:
+            color1 = blend(color1, color2, (x1 - x0) / float(-x0))
+            x0 = 0
+        if x1 > s:
+            color2 = blend(color1, color2, (s - x0) / float(s - x0))
+            x1 = s
+        x0 = max(0, int(x0))
+        x1 = min(s, int(x1)) + 1
+        # blend() for all x at once; int() truncates like astype(int) does
+        factor = (numpy.arange(x0, x1) - x0) / float(x1 - x0)
+        color1 = numpy.array(color1, numpy.int64)
+        delta = numpy.array(color2, numpy.int64) - color1
+        line = color1 + (delta * factor[:, None]).astype(numpy.int64)
+        self._image[max(self._top, int(y0 + .5)):min(self._bottom, int(y1 + .5)) + 1, x0:x1] = line
+
+    def restore_hor_line(self, x0, x1, y):
+        """x0 must be <= x1 """
+        s = self.s
+        if y < 0 or y > s or x0 > s or x1 < 0:
+            return
+        yr = int(y+.5)
+        if yr < self._top or yr > self._bottom:
+            return
+        x0 = max(0, int(x0))
+        x1 = min(s, int(x1)) + 1
+        self._image[yr, x0:x1] = self._saved[yr][x0:x1]
+
+    def fill_lines(self, rows, x0s, x1s, colors):
+        """Sets the pixels x0s[i] <= x < x1s[i] of row rows[i] for all i (the
+           arguments are numpy arrays; the lines must be clipped already, but
+           not to the band). colors is either one color, or an array with one
+           color per line. All pixels are written in one go."""
+        index, lengths = self._line_pixels(rows, x0s, x1s)
+        if not len(index):
+            return
+        colors = numpy.asarray(colors, numpy.uint8)
+        if colors.ndim == 2:
+            colors = numpy.repeat(colors, lengths, axis = 0)
+        self._image.reshape(-1, 3)[index] = colors
+
+    def _line_pixels(self, rows, x0s, x1s):
+        """Returns the flat indices of the pixels fill_lines() sets, and the
+           number of pixels in each line."""
+        lengths = numpy.maximum(x1s - x0s, 0)
+        lengths[(rows < self._top) | (rows > self._bottom)] = 0
+        total = int(lengths.sum())
+        # the flat index of every pixel: the start of its line plus its offset in the line
+        ends = numpy.cumsum(lengths)
+        index = numpy.repeat(rows * self.size + x0s - (ends - lengths), lengths) + numpy.arange(total)
+        return index, lengths
+
+    def annuli(self, center, radii, colors):
+        # SquareImage.annuli() for all rows and rings at once: the half width
+        # of every circle in every row, the widest line of the circles after
+        # it, and from those the one or two runs of the ring.
+        x0, y0 = center
+        s = self.s
+        circles = []
+        for i, radius in enumerate(radii):
+            radius = int(radius)
+            if radius < 0 or x0 < -radius or y0 < -radius or x0 - radius > self.size or y0 - radius > self.size:
+                continue
+            circles.append((radius, i))
+        if not circles:
+            return
+        outer = max(radius for radius, i in circles)
+        first = max(-outer, int(ceil(-y0)))
+        last = min(outer, int(floor(s - y0)))
+        if first > last:
+            return
+
+        widths = numpy.full((len(circles), last - first + 1), -1, numpy.int64)
+        for k, (radius, i) in enumerate(circles):
+            spans = circle_spans(radius)
+            lo, hi = max(first, -radius), min(last, radius)
+            if lo <= hi:
+                widths[k, lo - first:hi - first + 1] = spans[lo + radius:hi + radius + 1]
+        later = numpy.full_like(widths, -1)
+        later[:-1] = numpy.maximum.accumulate(widths[::-1], axis = 0)[::-1][1:]
+
+        line_a, line_b = line_extents(self.size, x0, widths)
+        inner_a, inner_b = line_extents(self.size, x0, later)
+        has_inner = inner_a < inner_b
+        rows = numpy.broadcast_to(numpy.trunc(y0 + numpy.arange(first, last + 1) + .5).astype(numpy.int64), widths.shape)
+        ring = numpy.broadcast_to(numpy.array([i for radius, i in circles])[:, None], widths.shape)
+        painted = (widths > later) & numpy.array([colors[i] is not None for radius, i in circles])[:, None]
+
+        left_b = numpy.where(has_inner, inner_a, line_b)
+        right_a = numpy.where(has_inner, inner_b, line_b)
+        palette = numpy.array([color if color is not None else (0, 0, 0) for color in colors], numpy.uint8)
+        for run_a, run_b in ((line_a, left_b), (right_a, line_b)):
+            run = painted & (run_a < run_b)
+            self.fill_lines(rows[run], run_a[run], run_b[run], palette[ring[run]])
+
+    def connect_circles(self, center1, radius1, color1, center2, radius2, color2):
+        capsule = self._capsule(center1, radius1, center2, radius2)
+        if capsule is None:
+            return
+        xmin, ymin, valid, l = capsule
+        col = numpy.array([tuple(int(v[0] + fac * (v[1] - v[0]) / 255) for v in zip(color1, color2)) for fac in range(256)], numpy.uint8)
+        box = self._image[ymin:ymin + valid.shape[0], xmin:xmin + valid.shape[1]]
+        box[valid] = col[(l[valid] * 255).astype(int)]
+
+    def _capsule(self, center1, radius1, center2, radius2):
+        """Finds the pixels connect_circles() sets: returns the top left corner
+           of their bounding box, a mask of them in the box, and the parameter
+           (0 at circle 1, 1 at circle 2) that gives their colors. None if
+           nothing is drawn.
+
+           This is SquareImage.connect_circles() done for the whole bounding
+           box at once. The floating point operations are the same ones in the
+           same order, so the result is identical pixel for pixel."""
+        center1 = list(map(int, center1))
+        center2 = list(map(int, center2))
+        radius1, radius2 = int(radius1), int(radius2)
+        xmin = int(max(0, min(center1[0] - radius1, center2[0] - radius2)))
+        xmax = int(min(self.s, max(center1[0] + radius1, center2[0] + radius2)))
+        ymin = int(max(self._top, min(center1[1] - radius1, center2[1] - radius2)))
+        ymax = int(min(self.s, self._bottom, max(center1[1] + radius1, center2[1] + radius2)))
+        if xmin > xmax or ymin > ymax:
+            return None
+
+        d = radius2 - radius1
+        vx = center2[0] - center1[0]
+        vy = center2[1] - center1[1]
+        a = float(vx**2 + vy**2 - d**2)
+
+        dx = numpy.arange(xmin - center1[0], xmax + 1 - center1[0], dtype = numpy.int64)[None, :]
+        dy = numpy.arange(ymin - center1[1], ymax + 1 - center1[1], dtype = numpy.int64)[:, None]
+        b = -2 * (vx * dx + (vy * dy + radius1 * d))
+        c = dx**2 + (dy**2 - radius1**2)
+        in_disc2 = (dx - vx)**2 < radius2**2 - (dy - vy)**2
+
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            if a == 0:
+                valid = b != 0
+                l = -c / b.astype(float)
+            else:
+                p = b / a
+                q = c / a
+                # not p**2, which numpy turns into p * p; that isn't always
+                # rounded the same way as the pow() behind Python's p**2
+                disc = numpy.float_power(p, 2) / 4 - q
+                valid = disc >= 0
+                sqrtdisc = numpy.sqrt(disc)
+                l = -p / 2 + sqrtdisc
+                l = numpy.where(l > 1, -p / 2 - sqrtdisc, l)
+
+        l = numpy.where(in_disc2, 1.0, l)
+        valid = (in_disc2 | valid) & (l <= 1)
+        valid &= (l >= 0) | (c <= 0)
+        return xmin, ymin, valid, numpy.clip(l, 0, 1)
+
+    # Depth buffered drawing: depth is a size x size float array (see
+    # depth_buffer()) with the depth of what's drawn at each pixel, smaller
+    # meaning closer, like the z of a projection. A pixel is only set if
+    # the surface being drawn is closer there; the pixels that are looked
+    # at are the ones circle() and connect_circles() would set.
+
+    # Bones that share a ball have the same front around it, up to rounding;
+    # to not have them take turns pixel by pixel there, a surface has to be
+    # closer by this much to replace what's drawn already.
+    DEPTH_TOLERANCE = 1e-6
+
+    def depth_buffer(self):
+        """Returns a depth buffer for this image, with nothing drawn yet. Only
+           the rows of the band (see set_band()) are set up; nothing else is
+           ever looked at."""
+        depth = numpy.empty((self.size, self.size))
+        depth[self._top:self._bottom + 1] = numpy.inf
+        return depth
+
+    def depth_circles(self, circles, depth, host = None):
+        """Draws the fronts of spheres, given as (center, radius, z, color)
+           tuples with z the depth of the center, all in one go and as one
+           thing, like the circles Bone.draw() steps along a bone: each pixel
+           gets the color of the last circle that covers it, like when the
+           circles are drawn one after the other, and the depth of the
+           closest front there.
+
+           host is a sphere (center, radius, z) that the circles lie on, see
+           Figure.put_on() in core.py. Where it covers them, they are drawn
+           as if they were in front of it even if they're (partly) inside."""
+        size = self.size
+        kept = [circle for circle in circles if int(circle[1]) >= 0]
+        if not kept:
+            return
+        x0s = numpy.array([center[0] for center, radius, z, color in kept], float)
+        y0s = numpy.array([center[1] for center, radius, z, color in kept], float)
+        radii = numpy.array([radius for center, radius, z, color in kept], float)
+        zs = numpy.array([z for center, radius, z, color in kept], float)
+        colors = numpy.array([color for center, radius, z, color in kept], numpy.uint8)
+
+        # the lines circle() would draw, for all circles at once: owners are
+        # the circles they belong to, see circle_lines() for the rest
+        whole = radii.astype(numpy.int64)
+        counts = 2 * whole + 1
+        owners = numpy.repeat(numpy.arange(len(kept)), counts)
+        offsets = numpy.arange(len(owners)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        widths = numpy.concatenate([_span_array(int(radius)) for center, radius, z, color in kept])
+        y = y0s[owners] + (offsets - whole[owners])
+        inside = (y >= 0) & (y <= self.s)
+        owners, y, widths = owners[inside], y[inside], widths[inside]
+        xa, xb = line_extents(size, x0s[owners], widths)
+        index, lengths = self._line_pixels(numpy.trunc(y + .5).astype(numpy.int64), xa, xb)
+        if not len(index):
+            return
+        owners = numpy.repeat(owners, lengths)
+
+        dx = index % size - x0s[owners]
+        dy = index // size - y0s[owners]
+        surface = zs[owners] - numpy.sqrt(numpy.maximum(radii[owners]**2 - dx**2 - dy**2, 0))
+
+        # group the pixels, and the circles covering each of them in the order
+        # they were given; the last circle of a group has the color
+        order = numpy.lexsort((owners, index))
+        index, surface, owners = index[order], surface[order], owners[order]
+        firsts = numpy.flatnonzero(numpy.concatenate(([True], index[1:] != index[:-1])))
+        lasts = numpy.concatenate((firsts[1:], [len(index)])) - 1
+        index, surface = index[firsts], numpy.minimum.reduceat(surface, firsts)
+        if host is not None:
+            surface = self._on_host(index, surface, host)
+        self._depth_write(index, surface, colors[owners[lasts]], depth)
+
+    def depth_capsule(self, center1, radius1, z1, color1, center2, radius2, z2, color2, depth, host = None):
+        """Draws what connect_circles() draws, with the depth of the front of
+           the bone, i.e. of the spheres swept from one end to the other. host
+           is like in depth_circles()."""
+        capsule = self._capsule(center1, radius1, center2, radius2)
+        if capsule is None:
+            return
+        xmin, ymin, valid, l = capsule
+        rows, columns = numpy.nonzero(valid)
+        if not len(rows):
+            return
+        y = rows + ymin
+        x = columns + xmin
+
+        # The sphere at t (from 0 at ball 1 to 1 at ball 2) covers the pixel
+        # where g(t) = r(t)**2 - (distance to its center)**2 = a t**2 + b t + c
+        # is >= 0, and its front is at f(t) = z(t) - sqrt(g(t)) there. f is
+        # smallest at one of the ends or where f'(t) = 0, which comes down
+        # to 4 a k t**2 + 4 b k t + b**2 - 4 vz**2 c = 0 with k = a - vz**2.
+        (x1, y1), (x2, y2) = center1, center2
+        vx, vy, vz, vr = x2 - x1, y2 - y1, z2 - z1, radius2 - radius1
+        px, py = x - x1, y - y1
+        a = vr**2 - vx**2 - vy**2
+        b = 2 * (radius1 * vr + px * vx + py * vy)
+        c = radius1**2 - px**2 - py**2
+        k = a - vz**2
+        candidates = [0., 1.]
+        if a and k:
+            with numpy.errstate(invalid = "ignore"):
+                root = abs(vz) * numpy.sqrt(k * (4 * a * c - b**2)) / (2 * a * k)
+            candidates += [numpy.clip(-b / (2 * a) - root, 0, 1), numpy.clip(-b / (2 * a) + root, 0, 1)]
+        surface = numpy.full(len(x), numpy.inf)
+        for t in candidates:
+            g = (a * t + b) * t + c
+            front = z1 + t * vz - numpy.sqrt(numpy.maximum(g, 0))
+            surface = numpy.where(g >= 0, numpy.fmin(surface, front), surface)
+        # rounding can leave a pixel of the outline outside of all spheres
+        surface = numpy.where(numpy.isinf(surface), z1 + l[valid] * vz, surface)
+
+        col = numpy.array([tuple(int(v[0] + fac * (v[1] - v[0]) / 255) for v in zip(color1, color2)) for fac in range(256)], numpy.uint8)
+        index = y * self.size + x
+        if host is not None:
+            surface = self._on_host(index, surface, host)
+        self._depth_write(index, surface, col[(l[valid] * 255).astype(int)], depth)
+
+    def _on_host(self, index, surface, host):
+        """Moves the surface at the pixels index to just in front of the front
+           of the sphere host where that covers them and is closer. Just in
+           front means far enough to replace what the host drew there."""
+        (x0, y0), radius, z = host
+        dx = index % self.size - x0
+        dy = index // self.size - y0
+        h = radius**2 - dx**2 - dy**2
+        front = z - numpy.sqrt(numpy.maximum(h, 0)) - 2 * self.DEPTH_TOLERANCE
+        return numpy.where(h >= 0, numpy.minimum(surface, front), surface)
+
+    def _depth_write(self, index, surface, colors, depth):
+        flat = depth.reshape(-1)
+        closer = surface < flat[index] - self.DEPTH_TOLERANCE
+        index = index[closer]
+        flat[index] = surface[closer]
+        if colors.ndim == 2:
+            colors = colors[closer]
+        self._image.reshape(-1, 3)[index] = colors
+
+    def _draw_spans(self, spans, radius, count, x0, y0, color):
+        s = self.s
+        first = max(0, int(ceil(radius - y0)))
+        last = min(count, int(floor(s - y0 + radius)) + 1)
+        top, bottom = self._top, self._bottom
+
+        image = self._image
+        restore = color == self.RESTORE
+        if restore:
+            saved = self._saved
+        for i in range(first, last):
+            y = int(y0 + (i - radius) + .5)
+            if y < top or y > bottom:
+                continue
+            w = spans[i]
+            left = x0 - w
+            right = x0 + w
+            if left > s or right < 0:
+                continue
+            xa = max(0, int(left))
+            xb = min(s, int(right)) + 1
+            if restore:
+                image[y, xa:xb] = saved[y][xa:xb]
+            else:
+                image[y, xa:xb] = color
+
+    def _fill(self, color, y, x0, x1):
+        self._image[y, x0:x1] = color
+
+    def _rgb_rows(self):
+        for line in self._image:
+            yield line.tobytes()
+
+    def _region_rows(self, left, top, right, bottom):
+        for line in self._image[top:bottom + 1, left:right + 1]:
+            yield line.tobytes()
+
+    @classmethod
+    def from_rgb_rows(cls, size, rows):
+        self = object.__new__(cls)
+        self._image = numpy.frombuffer(b"".join(rows), numpy.uint8).reshape(size, size, 3).copy()
+        self.size = size
+        self.s = size - 1
+        return self
+
+    def downsampled(self):
+        half = self.size // 2
+        image = self._image[:2 * half, :2 * half].astype(numpy.uint16)
+        total = image[0::2, 0::2] + image[0::2, 1::2] + image[1::2, 0::2] + image[1::2, 1::2]
+        result = object.__new__(type(self))
+        result._image = ((total + 2) >> 2).astype(numpy.uint8)
+        result.size = half
+        result.s = half - 1
+        return result
+
+    def to_bmp(self):
+        header, padding = self._bmp_header()
+        data = numpy.zeros((self.size, 3 * self.size + padding), numpy.uint8)
+        # BMP wants the rows bottom-up and the colors as BGR
+        data[:, :3 * self.size] = self._image[::-1, :, ::-1].reshape(self.size, -1)
+        return header + data.tobytes()
+
+
+@lru_cache(maxsize = 4096)
+def _bgr(color):
+    return bytes(reversed(color))
+
+
+class BufferImage(SquareImage):
+    """Same interface as SquareImage, but the image is a single bytearray
+       that already is the complete BMP file: header, then the rows bottom-up
+       as BGR with the padding in place. Drawing writes bytes straight into
+       the rows, and to_bmp() doesn't have to encode anything."""
+
+    @classmethod
+    def plain(cls, size, color):
+        self = object.__new__(cls)
+        self._setup(size)
+        pad = b"\0" * self._padding
+        self._buffer = bytearray(self._header + (_bgr(color) * size + pad) * size)
+        return self
+
+    @classmethod
+    def plain_band(cls, size, color, top, bottom):
+        self = object.__new__(cls)
+        self._setup(size)
+        self.set_band(top, bottom)
+        row = _bgr(color) * size + b"\0" * self._padding
+        self._buffer = bytearray(self._header) + bytearray(self._stride * size)
+        for y in range(self._top, self._bottom + 1):
+            offset = self._offset(y)
+            self._buffer[offset:offset + self._stride] = row
+        return self
+
+    def __init__(self, size, top_color, bottom_color):
+        self._setup(size)
+        delta = [b - t for b, t in zip(bottom_color, top_color)]
+        s = self.s
+        def color(y):
+            return tuple(t + d * y // s for t, d in zip(top_color, delta))
+        pad = b"\0" * self._padding
+        self._buffer = bytearray(self._header)
+        for y in range(s, -1, -1):
+            self._buffer += _bgr(color(y)) * size + pad
+
+    def _setup(self, size):
+        self.size = size
+        self.s = size - 1
+        self._header, self._padding = self._bmp_header()
+        self._stride = 3 * size + self._padding
+
+    def _offset(self, y):
+        """Index of the first byte of row y (counted from the top, as everywhere else)."""
+        return 54 + (self.s - y) * self._stride
+
+    def save(self, top = 0, bottom = None):
+        if bottom is None:
+            bottom = self.s
+        self._saved = {}
+        for y in range(max(0, top), min(self.s, bottom) + 1):
+            o = self._offset(y)
+            self._saved[y] = bytes(self._buffer[o:o + 3 * self.size])
+
+    def copy(self):
+        other = object.__new__(type(self))
+        other._setup(self.size)
+        other._buffer = bytearray(self._buffer)
+        return other
+
+    def copy_rows(self, source, top, bottom):
+        top, bottom = max(self._top, top), min(self.s, self._bottom, bottom)
+        if top > bottom:
+            return
+        # the rows are stored bottom-up, so the bottom row comes first
+        start = self._offset(bottom)
+        end = self._offset(top) + self._stride
+        self._buffer[start:end] = source._buffer[start:end]
+
+    def copy_rect(self, source, left, top, right, bottom):
+        left, right = max(0, left), min(self.s, right)
+        for y in range(max(self._top, top), min(self.s, self._bottom, bottom) + 1):
+            o = self._offset(y)
+            self._buffer[o + 3 * left:o + 3 * right + 3] = source._buffer[o + 3 * left:o + 3 * right + 3]
+
+    @property
+    def nbytes(self):
+        return len(self._buffer)
+
+    def hor_line(self, color, x0, x1, y):
+        """x0 must be <= x1 """
+        s = self.s
+        if y < 0 or y > s or x0 > s or x1 < 0:
+            return
+        yr = int(y+.5)
+        if yr < self._top or yr > self._bottom:
+            return
+        x0 = max(0, int(x0))
+        x1 = min(s, int(x1)) + 1
+        o = self._offset(yr)
+        self._buffer[o + 3 * x0:o + 3 * x1] = _bgr(color) * (x1 - x0)
+
+    def hor_gradient(self, color1, color2, x0, x1, y0, y1):
+        s = self.s
+        if y1 < 0 or y0 > s or x0 > s or x1 < 0:
+            return
+
+        if x0 < 0:
+            color1 = blend(color1, color2, (x1 - x0) / float(-x0))
+            x0 = 0
+        if x1 > s:
+            color2 = blend(color1, color2, (s - x0) / float(s - x0))
+            x1 = s
+        x0 = max(0, int(x0))
+        x1 = min(s, int(x1)) + 1
+        line = b"".join(_bgr(blend(color1, color2, (x - x0) / float(x1 - x0))) for x in range(x0, x1))
+        for y in range(max(self._top, int(y0 + .5)), min(self._bottom, int(y1 + .5)) + 1):
+            o = self._offset(y)
+            self._buffer[o + 3 * x0:o + 3 * x1] = line
+
+    def restore_hor_line(self, x0, x1, y):
+        """x0 must be <= x1 """
+        s = self.s
+        if y < 0 or y > s or x0 > s or x1 < 0:
+            return
+        yr = int(y+.5)
+        if yr < self._top or yr > self._bottom:
+            return
+        x0 = max(0, int(x0))
+        x1 = min(s, int(x1)) + 1
+        o = self._offset(yr)
+        self._buffer[o + 3 * x0:o + 3 * x1] = self._saved[yr][3 * x0:3 * x1]
+
+    def _draw_spans(self, spans, radius, count, x0, y0, color):
+        s = self.s
+        first = max(0, int(ceil(radius - y0)))
+        last = min(count, int(floor(s - y0 + radius)) + 1)
+        top, bottom = self._top, self._bottom
+
+        buffer = self._buffer
+        stride = self._stride
+        restore = color == self.RESTORE
+        if restore:
+            saved = self._saved
+        else:
+            bgr = _bgr(color)
+        for i in range(first, last):
+            y = int(y0 + (i - radius) + .5)
+            if y < top or y > bottom:
+                continue
+            w = spans[i]
+            left = x0 - w
+            right = x0 + w
+            if left > s or right < 0:
+                continue
+            xa = max(0, int(left))
+            xb = min(s, int(right)) + 1
+            o = 54 + (s - y) * stride
+            if restore:
+                buffer[o + 3 * xa:o + 3 * xb] = saved[y][3 * xa:3 * xb]
+            else:
+                buffer[o + 3 * xa:o + 3 * xb] = bgr * (xb - xa)
+
+    def _fill(self, color, y, x0, x1):
+        o = self._offset(y)
+        self._buffer[o + 3 * x0:o + 3 * x1] = _bgr(color) * (x1 - x0)
+
+    def _put(self, y, x, pixels):
+        o = self._offset(y) + 3 * x
+        self._buffer[o:o + 3 * len(pixels)] = b"".join(pixels)
+
+    _pixel = staticmethod(_bgr)
+
+    def _rgb_rows(self):
+        return self._region_rows(0, 0, self.s, self.s)
+
+    def _region_rows(self, left, top, right, bottom):
+        buffer = self._buffer
+        for y in range(top, bottom + 1):
+            o = self._offset(y)
+            bgr = buffer[o + 3 * left:o + 3 * right + 3]
+            rgb = bytearray(len(bgr))
+            rgb[0::3] = bgr[2::3]
+            rgb[1::3] = bgr[1::3]
+            rgb[2::3] = bgr[0::3]
+            yield bytes(rgb)
+
+    @classmethod
+    def from_rgb_rows(cls, size, rows):
+        self = object.__new__(cls)
+        self._setup(size)
+        self._buffer = bytearray(self._header) + bytearray(self._stride * size)
+        for y, rgb in enumerate(rows):
+            o = self._offset(y)
+            self._buffer[o:o + 3 * size:3] = rgb[2::3]
+            self._buffer[o + 1:o + 3 * size:3] = rgb[1::3]
+            self._buffer[o + 2:o + 3 * size:3] = rgb[0::3]
+        return self
+
+    def to_bmp(self):
+        """Returns a memoryview of the image itself, i.e. drawing on the image
+           afterwards changes the returned data as well."""
+        return memoryview(self._buffer)
+
+
+backends = {"python": SquareImage, "buffer": BufferImage}
+if numpy is not None:
+    backends["numpy"] = ArrayImage
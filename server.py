@@ -0,0 +1,315 @@
+# Copyright 2010 Benjamin Dumke
+#
+# This file is part of Unicornify
+#
+# Unicornify is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Unicornify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the NU Affero General Public License
+# along with Unicornify; see the file COPYING. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""An HTTP server for unicorn avatars:
+
+       GET /avatar/<hex hash>?s=<size>&bg=0|1
+
+   returns a size x size PNG (antialiased, see create_avatar()'s downsample);
+   GET /metrics returns counters and latency histograms in the Prometheus
+   text format. Usage: python3 server.py [host] [port]"""
+
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+from avatar import create_avatar, BadHashString
+from graphics import backends, warm_span_tables
+
+
+class Overloaded(Exception):
+    pass
+
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+          500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def parse_hash(text):
+    """Turns the hex hash from the URL into the number create_avatar() wants."""
+    if not text or len(text) > 128:
+        raise BadHashString(text)
+    try:
+        return int(text, 16)
+    except ValueError:
+        raise BadHashString(text)
+
+
+def render(hash_val, size, with_background, zbuffer = False):
+    """Runs in the worker processes. Uses the numpy backend if there is one
+       (the z-buffer needs it)."""
+    backend = "numpy" if zbuffer or "numpy" in backends else "python"
+    return bytes(create_avatar(size, hash_val, with_background, backend, format = "png", downsample = True,
+                               zbuffer = zbuffer))
+
+
+def _warm_up():
+    warm_span_tables(256)
+    render(0, 64, True)
+
+
+class Histogram(object):
+    """Counts observations into buckets given by their (sorted) upper bounds."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def lines(self, name):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            yield '%s_bucket{le="%s"} %d' % (name, bound, cumulative)
+        yield "%s_sum %f" % (name, self.total)
+        yield "%s_count %d" % (name, self.count)
+
+
+LATENCY_BUCKETS = [.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10]
+
+
+class AvatarServer(object):
+    """Renders in a pool of workers processes, so the event loop only ever
+       does I/O and stays responsive while all cores are busy rendering.
+
+       Concurrent requests for the same avatar share one render. At most
+       max_inflight renders are in the pool at a time; the others wait for
+       a slot, and once max_waiting renders are waiting, further ones are
+       turned away with a 503. Connections are kept alive (HTTP/1.1 style)
+       until the client closes them or is idle for keep_alive_timeout
+       seconds. With zbuffer=True, avatars are drawn with create_avatar()'s
+       z-buffer mode, which needs numpy; without it, that raises a ValueError
+       right here instead of failing every request."""
+
+    def __init__(self, workers = None, max_inflight = None, max_waiting = 1000, max_size = 512,
+                 keep_alive_timeout = 15, zbuffer = False):
+        if zbuffer and "numpy" not in backends:
+            raise ValueError("The z-buffer needs numpy")
+        self.workers = workers or os.cpu_count()
+        # a few more than there are workers, so no worker ever sits idle
+        self.max_inflight = max_inflight or 2 * self.workers
+        self.max_waiting = max_waiting
+        self.max_size = max_size
+        self.keep_alive_timeout = keep_alive_timeout
+        self.zbuffer = zbuffer
+
+        self.inflight = 0
+        self.waiting = 0
+        self.responses = {}
+        self.renders = 0
+        self.shared_renders = 0
+        self.render_errors = 0
+        self.rejected = 0
+        self.request_latency = Histogram(LATENCY_BUCKETS)
+        self.render_latency = Histogram(LATENCY_BUCKETS)
+
+        self._renders = {}
+        self._slots = None
+        self._executor = None
+        self._server = None
+        self._connections = {}
+
+    async def start(self, host = "127.0.0.1", port = 8080):
+        # Forked workers would inherit the sockets of the connections open
+        # at the time, and keep them open after the server closes them.
+        self._executor = ProcessPoolExecutor(self.workers, multiprocessing.get_context("spawn"),
+                                             initializer = _warm_up)
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # idle keep-alive connections would keep their handlers waiting
+            for writer in list(self._connections):
+                writer.close()
+            await asyncio.gather(*self._connections.values(), return_exceptions = True)
+            await self._server.wait_closed()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    async def avatar(self, hash_val, size, with_background):
+        """Returns the PNG, rendering it unless the same one is being
+           rendered already."""
+        key = (hash_val, size, with_background)
+        future = self._renders.get(key)
+        if future is not None:
+            self.shared_renders += 1
+        else:
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise Overloaded()
+            # counted right away: the task only starts once this request's
+            # handler yields, and a burst of requests would all get in before
+            self.waiting += 1
+            future = asyncio.ensure_future(self._render(key))
+            self._renders[key] = future
+            future.add_done_callback(lambda f: self._render_done(key, f))
+        # a client going away must not cancel the render for the others
+        return await asyncio.shield(future)
+
+    def _render_done(self, key, future):
+        del self._renders[key]
+        if not future.cancelled() and future.exception() is not None:
+            self.render_errors += 1
+
+    async def _render(self, key):
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.inflight += 1
+        try:
+            start = time.monotonic()
+            result = await asyncio.get_running_loop().run_in_executor(self._executor, render, *key, self.zbuffer)
+            self.render_latency.observe(time.monotonic() - start)
+            self.renders += 1
+            return result
+        finally:
+            self.inflight -= 1
+            self._slots.release()
+
+    def metrics(self):
+        lines = ["# TYPE unicornify_responses_total counter"]
+        for status, count in sorted(self.responses.items()):
+            lines.append('unicornify_responses_total{status="%d"} %d' % (status, count))
+        lines += ["unicornify_renders_total %d" % self.renders,
+                  "unicornify_shared_renders_total %d" % self.shared_renders,
+                  "unicornify_render_errors_total %d" % self.render_errors,
+                  "unicornify_rejected_total %d" % self.rejected,
+                  "unicornify_renders_inflight %d" % self.inflight,
+                  "unicornify_renders_waiting %d" % self.waiting,
+                  "# TYPE unicornify_request_seconds histogram"]
+        lines += self.request_latency.lines("unicornify_request_seconds")
+        lines.append("# TYPE unicornify_render_seconds histogram")
+        lines += self.render_latency.lines("unicornify_render_seconds")
+        return ("\n".join(lines) + "\n").encode("ascii")
+
+    async def respond(self, method, target):
+        """Returns status, content type, body and additional headers."""
+        if method not in ("GET", "HEAD"):
+            return 405, "text/plain", b"Method not allowed\n", [("Allow", "GET, HEAD")]
+        url = urlsplit(target)
+        if url.path == "/metrics":
+            return 200, "text/plain; version=0.0.4", self.metrics(), []
+        if not url.path.startswith("/avatar/"):
+            return 404, "text/plain", b"Not found\n", []
+
+        query = parse_qs(url.query)
+        try:
+            hash_val = parse_hash(url.path[len("/avatar/"):])
+            size = int(query.get("s", ["128"])[-1])
+            background = query.get("bg", ["1"])[-1]
+            if not 1 <= size <= self.max_size or background not in ("0", "1"):
+                raise ValueError()
+        except (BadHashString, ValueError):
+            return 400, "text/plain", b"Bad request\n", []
+
+        try:
+            png = await self.avatar(hash_val, size, background == "1")
+        except Overloaded:
+            return 503, "text/plain", b"Too busy\n", [("Retry-After", "1")]
+        except Exception:
+            return 500, "text/plain", b"Rendering failed\n", []
+        return 200, "image/png", png, [("Cache-Control", "public, max-age=86400")]
+
+    async def _handle_connection(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                start = time.monotonic()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+                    method = None
+                    status, content_type, body, extra = 400, "text/plain", b"Bad request\n", []
+                    keep_alive = False
+                else:
+                    method, target, version = parts
+                    length = int(headers.get("content-length", "0") or 0)
+                    if length:
+                        await reader.readexactly(length)
+                    connection = headers.get("connection", "").lower()
+                    if version == "HTTP/1.0":
+                        keep_alive = connection == "keep-alive"
+                    else:
+                        keep_alive = connection != "close"
+                    status, content_type, body, extra = await self.respond(method, target)
+
+                head = ["HTTP/1.1 %d %s" % (status, STATUS[status]),
+                        "Content-Type: %s" % content_type,
+                        "Content-Length: %d" % len(body),
+                        "Connection: %s" % ("keep-alive" if keep_alive else "close")]
+                head += ["%s: %s" % header for header in extra]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+
+                self.responses[status] = self.responses.get(status, 0) + 1
+                self.request_latency.observe(time.monotonic() - start)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # ValueError: a line longer than the reader's limit, or a bad Content-Length
+            pass
+        finally:
+            del self._connections[writer]
+            writer.close()
+
+
+async def serve(host = "127.0.0.1", port = 8080, **options):
+    server = AvatarServer(**options)
+    listener = await server.start(host, port)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    host = sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    asyncio.run(serve(host, port))
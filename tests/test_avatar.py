@@ -0,0 +1,145 @@
+import pytest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import avatar
+from avatar import (AvatarSpec, _paint, _spec_and_unicorn, avatar_spec, create_avatar, create_avatar_pyramid,
+                    create_avatars, render_spec)
+from core import WorldView
+from graphics import backends
+
+HASHES = [0, 0x21b96dcc68138, 0x18011847b11145af, 0x1895854ba5a70]
+
+
+def test_backends_draw_the_same_pixels():
+    for hash_val in HASHES:
+        for size in (16, 50):
+            for with_background in (True, False):
+                images = set(bytes(create_avatar(size, hash_val, with_background, backend))
+                             for backend in backends)
+                assert len(images) == 1
+
+
+def test_avatar_spec_round_trips():
+    for hash_val in HASHES:
+        spec = avatar_spec(32, hash_val)
+        for copy in (AvatarSpec.from_json(spec.to_json()), AvatarSpec.from_bytes(spec.to_bytes())):
+            assert copy == spec
+            assert copy.to_json() == spec.to_json() and copy.to_bytes() == spec.to_bytes()
+            assert render_spec(copy) == create_avatar(32, hash_val)
+        assert render_spec(spec, False, format = "png") == create_avatar(32, hash_val, False, format = "png")
+
+
+def test_avatar_spec_of_another_version_fails():
+    spec = avatar_spec(32, 1)
+    data = bytearray(spec.to_bytes())
+    data[len(AvatarSpec.MAGIC) + 1] += 1
+    with pytest.raises(ValueError):
+        AvatarSpec.from_bytes(data)
+    with pytest.raises(ValueError):
+        AvatarSpec.from_json(spec.to_json().replace('"version":1', '"version":2'))
+    with pytest.raises(ValueError):
+        AvatarSpec.from_bytes(b"not a spec")
+
+
+def scene(size, hash_val, with_background, backend, zbuffer = False):
+    spec, unicorn = _spec_and_unicorn(size, hash_val)
+    wv = WorldView(spec.y_angle, spec.x_angle, (150, 0, 0), spec.shift)
+    unicorn.sort(wv, order = not zbuffer)
+    return spec, unicorn, wv, with_background, backend, zbuffer
+
+
+@pytest.mark.parametrize("backend", sorted(backends))
+def test_bands_put_together_are_the_whole_image(backend):
+    for hash_val in HASHES:
+        for with_background in (True, False):
+            current = scene(40, hash_val, with_background, backend)
+            whole = list(_paint(current)._rgb_rows())
+            for bands in (2, 3, 7, 80):
+                edges = [80 * i // bands for i in range(bands + 1)]
+                rows = []
+                for top, bottom in zip(edges, edges[1:]):
+                    image = _paint(current, (top, bottom - 1))
+                    rows += image._region_rows(0, top, image.s, bottom - 1)
+                assert rows == whole
+
+
+@pytest.mark.skipif("numpy" not in backends, reason = "the z-buffer needs numpy")
+def test_bands_with_a_depth_buffer():
+    for hash_val in HASHES:
+        current = scene(40, hash_val, True, "numpy", zbuffer = True)
+        whole = list(_paint(current)._rgb_rows())
+        rows = []
+        for top, bottom in ((0, 10), (11, 11), (12, 79)):
+            image = _paint(current, (top, bottom))
+            rows += image._region_rows(0, top, image.s, bottom)
+        assert rows == whole
+
+
+@pytest.mark.skipif("numpy" not in backends, reason = "the z-buffer needs numpy")
+def test_eyes_with_a_depth_buffer():
+    # the pupils are a bit inside the eyes, which the depth buffer mustn't
+    # hide; only where the brows overlap the eyes may the two renders differ
+    for hash_val in HASHES:
+        spec, unicorn = _spec_and_unicorn(64, hash_val)
+        painted = _paint(scene(64, hash_val, True, "numpy"))._image
+        buffered = _paint(scene(64, hash_val, True, "numpy", zbuffer = True))._image
+        for eye in (unicorn.eye_left, unicorn.eye_right):
+            x, y = (p + shift for p, shift in zip(eye.twoD(), spec.shift))
+            rows, columns = numpy.mgrid[:128, :128]
+            inside = (columns - x)**2 + (rows - y)**2 <= eye.radius**2
+            differ = (painted[inside] != buffered[inside]).any(axis = 1)
+            assert differ.mean() < .05
+
+
+def test_banded_create_avatar_in_processes():
+    for backend in backends:
+        expected = bytes(create_avatar(64, HASHES[1], backend = backend))
+        assert bytes(create_avatar(64, HASHES[1], backend = backend, bands = 3)) == expected
+    pool = avatar._pool
+    pyramid = create_avatar_pyramid([64, 32], HASHES[2], format = "png")
+    assert create_avatar_pyramid([64, 32], HASHES[2], format = "png", bands = 4) == pyramid
+    # the processes are started once and kept
+    assert avatar._pool is pool
+
+
+def test_small_avatars_are_drawn_in_one_go(monkeypatch):
+    monkeypatch.setattr(avatar, "_pool", None)
+    expected = bytes(create_avatar(avatar.BAND_MIN_SIZE - 1, HASHES[1]))
+    assert bytes(create_avatar(avatar.BAND_MIN_SIZE - 1, HASHES[1], bands = 3)) == expected
+    assert avatar._pool is None
+
+
+def test_create_avatars():
+    # [4] isn't a valid seed, so that one hash fails
+    hashes = [HASHES[1], 7, [4], 7, HASHES[3]]
+    expected = [(hash_val, bytes(create_avatar(16, hash_val, format = "png"))) for hash_val in hashes if hash_val != [4]]
+    for ordered in (True, False):
+        results = list(create_avatars(hashes, 16, format = "png", workers = 2, chunksize = 2, ordered = ordered))
+        assert len(results) == len(hashes)
+        failed = [result for hash_val, result in results if hash_val == [4]]
+        assert len(failed) == 1 and isinstance(failed[0], TypeError)
+        drawn = [(hash_val, result) for hash_val, result in results if hash_val != [4]]
+        if ordered:
+            assert drawn == expected
+        else:
+            assert sorted(drawn) == sorted(expected)
+
+
+def test_create_avatars_checks_the_options_right_away():
+    with pytest.raises(KeyError):
+        create_avatars([1, 2], 16, backend = "nope")
+    with pytest.raises(ValueError):
+        create_avatars([1, 2], 16, format = "jpeg")
+
+
+def test_bad_arguments():
+    with pytest.raises(ValueError):
+        create_avatar(32, 1, bands = 0)
+    with pytest.raises(ValueError):
+        create_avatar_pyramid([], 1)
+    with pytest.raises(KeyError):
+        create_avatar(32, 1, backend = "nope")
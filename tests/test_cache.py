@@ -0,0 +1,100 @@
+import hashlib
+import os
+
+from avatar import avatar_key, create_avatar
+from cache import DiskCache, MemoryCache, TieredCache
+
+
+def key(name):
+    return hashlib.sha1(name.encode("ascii")).digest()
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_disk_cache_round_trip(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    assert cache.get(key("a")) is None
+    cache.put(key("a"), b"first")
+    cache.put(key("b"), b"second" * 1000)
+    assert cache.get(key("a")) == b"first"
+    assert cache.get(key("b")) == b"second" * 1000
+    assert (cache.hits, cache.misses, len(cache)) == (2, 1, 2)
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), budget = 250)
+    for name in "abc":
+        cache.put(key(name), name.encode("ascii") * 100)
+        # reading "a" keeps it, so "b" is the oldest when "c" comes in
+        cache.get(key("a"))
+    assert cache.get(key("b")) is None
+    assert cache.get(key("a")) == b"a" * 100
+    assert cache.get(key("c")) == b"c" * 100
+    assert cache.used == 200 and cache.evictions == 1
+    assert not os.path.exists(cache._path(key("b")))
+
+
+def test_disk_cache_reopens_with_its_lru_order(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    for name in "abc":
+        cache.put(key(name), name.encode("ascii") * 100)
+    cache.get(key("a"))
+    cache.close()
+
+    # a file written after the index was saved is picked up as the oldest
+    stray = cache._path(key("d"))
+    os.makedirs(os.path.dirname(stray), exist_ok = True)
+    with open(stray, "wb") as f:
+        f.write(b"d" * 100)
+
+    reopened = DiskCache(str(tmp_path), budget = 300)
+    assert len(reopened) == 3
+    assert reopened.get(key("d")) is None
+    assert reopened.get(key("b")) is not None
+    reopened.put(key("e"), b"e" * 100)
+    assert reopened.get(key("c")) is None
+    assert reopened.get(key("a")) is not None
+
+
+def test_memory_cache_budget_and_ttl():
+    clock = Clock()
+    cache = MemoryCache(budget = 250, ttl = 10, clock = clock)
+    cache.put(key("a"), b"a" * 100)
+    cache.put(key("b"), b"b" * 100)
+    cache.get(key("a"))
+    cache.put(key("c"), b"c" * 100)
+    assert cache.get(key("b")) is None
+    assert cache.get(key("a")) == b"a" * 100
+    assert cache.used == 200
+
+    clock.now = 10
+    assert cache.get(key("a")) is None
+    assert cache.expirations == 1 and cache.used == 100
+
+
+def test_tiered_cache_promotes_hits(tmp_path):
+    memory, disk = MemoryCache(), DiskCache(str(tmp_path))
+    cache = TieredCache(memory, disk)
+    disk.put(key("a"), b"a" * 100)
+    assert cache.get(key("a")) == b"a" * 100
+    assert memory.get(key("a")) == b"a" * 100
+    cache.put(key("b"), b"b")
+    assert memory.get(key("b")) == b"b" and disk.get(key("b")) == b"b"
+
+
+def test_create_avatar_uses_the_cache(tmp_path):
+    cache = TieredCache(MemoryCache(), DiskCache(str(tmp_path)))
+    drawn = create_avatar(32, 7, format = "png", cache = cache)
+    assert cache.get(avatar_key(32, 7, format = "png")) == drawn
+    assert create_avatar(32, 7, format = "png", cache = cache) == drawn
+
+    # a hit straight from the disk is bytes, too, not a view of the file
+    disk = DiskCache(str(tmp_path / "disk"))
+    create_avatar(32, 7, format = "png", cache = disk)
+    assert create_avatar(32, 7, format = "png", cache = disk) == drawn
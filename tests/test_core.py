@@ -0,0 +1,177 @@
+from random import Random
+
+import pytest
+
+from avatar import _spec_and_unicorn
+from core import Ball, Bone, Figure, WorldView, compare, depth_order, evilness, two_combinations
+
+
+def old_depth_order(things, worldview):
+    """The quadratic Figure.sort() that depth_order() replaced, minus the
+       sorting of the things themselves."""
+    draw_after = dict((thing, []) for thing in things)
+
+    for first, second in two_combinations(things):
+        if second not in draw_after[first] and first not in draw_after[second]:
+            if first.bounding().intersects(second.bounding()):
+                c = compare(worldview, first, second)
+                if c < 0:
+                    draw_after[first].append(second)
+                elif c > 0:
+                    draw_after[second].append(first)
+
+    sorted_things = []
+    queue = []
+    for thing, deps in list(draw_after.items()):
+        if not deps:
+            queue.append(thing)
+            del draw_after[thing]
+
+    while draw_after:
+        while queue:
+            popped = queue.pop()
+            sorted_things.append(popped)
+            for thing, deps in list(draw_after.items()):
+                if popped in deps:
+                    deps.remove(popped)
+                    if not deps:
+                        queue.append(thing)
+                        del draw_after[thing]
+
+        if draw_after:
+            least_evil = min((thing for thing in draw_after.keys()), key = evilness)
+            sorted_things.append(least_evil)
+            del draw_after[least_evil]
+            for thing, deps in list(draw_after.items()):
+                if least_evil in deps:
+                    deps.remove(least_evil)
+                    if not deps:
+                        queue.append(thing)
+                        del draw_after[thing]
+
+    return sorted_things
+
+
+def random_figure(randomizer):
+    """Balls and bones between them, crowded enough that many overlap and
+       some of the constraints contradict each other."""
+    uniform = randomizer.uniform
+    balls = [Ball((uniform(-100, 100), uniform(-100, 100), uniform(-100, 100)), uniform(2, 30), (0, 0, 0))
+             for i in range(randomizer.randint(2, 30))]
+    figure = Figure()
+    for i, ball in enumerate(balls):
+        # bones only to earlier balls, so no two bones have the same balls
+        if i and randomizer.random() < .6:
+            figure.add(Bone(ball, balls[randomizer.randrange(i)]))
+        else:
+            figure.add(ball)
+    return figure
+
+
+def test_depth_order_matches_old_sort_on_random_figures():
+    randomizer = Random(12)
+    for i in range(300):
+        figure = random_figure(randomizer)
+        wv = WorldView(randomizer.randint(0, 359), randomizer.randint(-30, 30), (0, 0, 0), (0, 0))
+        figure.project(wv)
+        for thing in figure._things:
+            thing.sort(wv)
+        assert depth_order(figure._things, wv) == old_depth_order(figure._things, wv)
+
+
+def test_depth_order_matches_old_sort_on_unicorns():
+    for hash_val in (0, 1, 0x21b96dcc68138, 0x18011847b11145af):
+        spec, unicorn = _spec_and_unicorn(128, hash_val)
+        wv = WorldView(spec.y_angle, spec.x_angle, (150, 0, 0), spec.shift)
+        for thing in unicorn._things:
+            thing.sort(wv)
+        assert depth_order(unicorn._things, wv) == old_depth_order(unicorn._things, wv)
+
+
+def ordered_balls(figure):
+    return list(dict.fromkeys(figure.balls()))
+
+
+def test_deferred_transforms_match_moving_ball_by_ball():
+    """Figure.rotate() and scale() are recorded and combined later; the balls
+       have to end up where rotating and scaling all of them right away
+       puts them."""
+    for seed in range(50):
+        deferred, eager = Figure(), Figure()
+        moves = Random(seed)
+        for step in range(6):
+            # the same things in both, each with balls of its own
+            deferred.add(random_figure(Random(1000 * seed + step)))
+            eager.add(random_figure(Random(1000 * seed + step)))
+            if moves.random() < .3:
+                factor = moves.uniform(.5, 2)
+                deferred.scale(factor)
+                for ball in eager.ball_set():
+                    ball.radius *= factor
+                    ball.center = tuple(c * factor for c in ball.center)
+            else:
+                angle, axis = moves.uniform(-180, 180), moves.randrange(3)
+                k = moves.randrange(len(ordered_balls(eager)))
+                deferred.rotate(angle, ordered_balls(deferred)[k], axis)
+                pivot = ordered_balls(eager)[k]
+                for ball in eager.ball_set():
+                    if ball is not pivot:
+                        ball.rotate(angle, pivot, axis)
+        deferred.apply_transforms()
+        for ball, expected in zip(ordered_balls(deferred), ordered_balls(eager)):
+            assert ball.radius == pytest.approx(expected.radius)
+            assert ball.center == pytest.approx(expected.center, abs = 1e-6)
+
+
+def test_moving_balls_with_transforms_pending_fails():
+    first, second = Ball((0, 0, 0), 5, None), Ball((10, 0, 0), 5, None)
+    figure = Figure()
+    figure.add(Bone(first, second))
+    figure.rotate(90, first)
+    with pytest.raises(ValueError):
+        second.rotate(10, first)
+    with pytest.raises(ValueError):
+        Ball((3, 3, 3), 1, None).set_distance(4, second)
+    figure.apply_transforms()
+    second.rotate(-90, first)
+    assert second.center == pytest.approx((10, 0, 0))
+
+
+def nested_figures():
+    pivot, inner = Ball((5, 0, 0), 1, None), Ball((10, 2, 0), 1, None)
+    child, parent = Figure(), Figure()
+    child.add(inner)
+    parent.add(pivot, child)
+    return pivot, inner, child, parent
+
+
+def test_nested_transforms_are_applied_in_the_order_they_were_recorded():
+    # scaling around the origin and rotating around pivot don't commute
+    pivot, inner, child, parent = nested_figures()
+    child.scale(2)
+    parent.rotate(90, pivot)
+    parent.apply_transforms()
+    eager = Ball((20, 4, 0), 1, None)
+    eager.rotate(90, Ball((5, 0, 0), 1, None))
+    assert inner.center == pytest.approx(eager.center)
+
+    # the pivot is where the subfigure's pending transforms put it
+    pivot, inner, child, parent = nested_figures()
+    child.scale(2)
+    parent.rotate(90, inner)
+    parent.apply_transforms()
+    assert inner.center == pytest.approx((20, 4, 0))
+    assert pivot.center == pytest.approx((24, -11, 0))
+
+
+def test_subfigure_transforms_after_the_parents_fail():
+    pivot, inner, child, parent = nested_figures()
+    parent.rotate(90, pivot)
+    with pytest.raises(ValueError):
+        child.scale(2)
+    with pytest.raises(ValueError):
+        Figure().rotate(10, inner)
+    parent.apply_transforms()
+    child.scale(2)
+    child.apply_transforms()
+    assert inner.center == pytest.approx((6, 10, 0))
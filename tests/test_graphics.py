@@ -0,0 +1,213 @@
+import io
+import struct
+import zlib
+from random import Random
+
+from avatar import UnicornData, _draw, _fill, _make_unicorn, _spec_and_unicorn, create_animation, create_avatar
+from core import WorldView
+from graphics import (SquareImage, color_counts, gif_palette, index_rows, write_apng, write_gif,
+                      write_png)
+
+
+def read_png(data):
+    """Decodes the RGB PNGs and APNGs written by graphics.py (filters 0 and 2
+       only). Returns the frames, each as the list of rows of the whole image
+       after that frame was put on the previous one."""
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    pos = 8
+    frames = []
+    while pos < len(data):
+        length, tag = struct.unpack(">I4s", data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        assert struct.unpack(">I", data[pos + 8 + length:pos + 12 + length])[0] == zlib.crc32(tag + body)
+        pos += 12 + length
+        if tag == b"IHDR":
+            width, height, depth, color_type = struct.unpack(">2I2B", body[:10])
+            assert (depth, color_type) == (8, 2)
+            frames.append([width, height, 0, 0, b""])
+        elif tag == b"fcTL":
+            sequence, frame_width, frame_height, left, top = struct.unpack(">5I", body[:20])
+            frame = [frame_width, frame_height, left, top, b""]
+            if frames[-1][4]:
+                frames.append(frame)
+            else:
+                # the first frame is the IDAT one
+                frames[-1] = frame
+        elif tag == b"IDAT":
+            frames[-1][4] += body
+        elif tag == b"fdAT":
+            frames[-1][4] += body[4:]
+
+    canvas = [bytearray(3 * width) for y in range(height)]
+    result = []
+    for frame_width, frame_height, left, top, compressed in frames:
+        raw = zlib.decompress(compressed)
+        stride = 3 * frame_width + 1
+        assert len(raw) == stride * frame_height
+        previous = bytes(3 * frame_width)
+        for y in range(frame_height):
+            kind, row = raw[y * stride], raw[y * stride + 1:(y + 1) * stride]
+            assert kind in (0, 2)
+            if kind == 2:
+                row = bytes((a + b) & 255 for a, b in zip(row, previous))
+            canvas[top + y][3 * left:3 * (left + frame_width)] = row
+            previous = row
+        result.append([bytes(row) for row in canvas])
+    return result
+
+
+def read_gif(data):
+    """Decodes the GIFs written by graphics.py; returns the palette and the
+       frames, as palette indices, each the whole image after that frame."""
+    assert data[:6] == b"GIF89a"
+    width, height, flags = struct.unpack("<2HB", data[6:11])
+    pos = 13
+    palette = [tuple(data[pos + 3 * i:pos + 3 * i + 3]) for i in range(2 << (flags & 7))]
+    pos += 3 * len(palette)
+    canvas = [bytearray(width) for y in range(height)]
+    frames = []
+    while True:
+        block = data[pos]
+        pos += 1
+        if block == 0x3b:
+            return palette, frames
+        if block == 0x21:
+            pos += 1
+            while data[pos]:
+                pos += data[pos] + 1
+            pos += 1
+            continue
+        assert block == 0x2c
+        left, top, frame_width, frame_height, frame_flags = struct.unpack("<4HB", data[pos:pos + 9])
+        min_code_size = data[pos + 9]
+        pos += 10
+        stream = bytearray()
+        while data[pos]:
+            stream += data[pos + 1:pos + 1 + data[pos]]
+            pos += data[pos] + 1
+        pos += 1
+
+        bits = int.from_bytes(stream, "little")
+        bit = 0
+        clear = 1 << min_code_size
+        out = bytearray()
+        table = None
+        while True:
+            if table is None:
+                table = [bytes((i,)) for i in range(clear)] + [None, None]
+                size = min_code_size + 1
+                previous = None
+            code = (bits >> bit) & ((1 << size) - 1)
+            bit += size
+            assert bit <= 8 * len(stream)
+            if code == clear:
+                table = None
+                continue
+            if code == clear + 1:
+                break
+            if previous is None:
+                entry = table[code]
+            else:
+                entry = table[code] if code < len(table) else table[previous] + table[previous][:1]
+                if len(table) < 4096:
+                    table.append(table[previous] + entry[:1])
+                    if len(table) == 1 << size and size < 12:
+                        size += 1
+            out += entry
+            previous = code
+        assert len(out) == frame_width * frame_height
+        for y in range(frame_height):
+            canvas[top + y][left:left + frame_width] = out[y * frame_width:(y + 1) * frame_width]
+        frames.append([bytes(row) for row in canvas])
+
+
+def random_rows(randomizer, width, height, colors):
+    """Rows of a few colors, with runs and repeated rows like in the avatars."""
+    palette = [bytes(randomizer.randrange(256) for c in range(3)) for i in range(colors)]
+    rows = []
+    for y in range(height):
+        if rows and randomizer.random() < .3:
+            rows.append(rows[-1])
+            continue
+        row = b""
+        while len(row) < 3 * width:
+            row += randomizer.choice(palette) * randomizer.randint(1, 8)
+        rows.append(row[:3 * width])
+    return rows
+
+
+def test_png_round_trip():
+    randomizer = Random(1)
+    for width, height in ((1, 1), (7, 5), (300, 40)):
+        rows = random_rows(randomizer, width, height, 20)
+        out = io.BytesIO()
+        write_png(out, width, height, iter(rows))
+        assert read_png(out.getvalue()) == [rows]
+
+
+def test_avatar_png_decodes_to_its_pixels():
+    image = SquareImage.from_rgb_rows(64, read_png(create_avatar(32, 5, format = "png"))[0])
+    assert bytes(image.to_bmp()) == bytes(create_avatar(32, 5))
+
+
+def test_apng_frames_replace_their_rectangles():
+    randomizer = Random(2)
+    width, height = 40, 30
+    expected = random_rows(randomizer, width, height, 30)
+    frames = [(0, 0, width, height, 80, expected)]
+    canvases = [expected]
+    for i in range(5):
+        left, top = randomizer.randrange(width), randomizer.randrange(height)
+        frame_width, frame_height = randomizer.randint(1, width - left), randomizer.randint(1, height - top)
+        rows = random_rows(randomizer, frame_width, frame_height, 5)
+        frames.append((left, top, frame_width, frame_height, 80, rows))
+        expected = [row if not top <= y < top + frame_height else
+                    row[:3 * left] + rows[y - top] + row[3 * (left + frame_width):]
+                    for y, row in enumerate(expected)]
+        canvases.append(expected)
+    out = io.BytesIO()
+    write_apng(out, width, height, frames)
+    assert read_png(out.getvalue()) == canvases
+
+
+def test_gif_round_trip_with_few_colors():
+    randomizer = Random(3)
+    for width, height, colors in ((1, 1, 1), (9, 4, 2), (200, 100, 256)):
+        rows = random_rows(randomizer, width, height, colors)
+        palette, mapping = gif_palette(color_counts(rows))
+        out = io.BytesIO()
+        write_gif(out, width, height, [(0, 0, width, height, 0, index_rows(rows, mapping))], palette)
+        decoded_palette, frames = read_gif(out.getvalue())
+        assert [bytes(b for i in row for b in decoded_palette[i]) for row in frames[0]] == rows
+
+
+def test_gif_code_table_resets():
+    # noise fills the 4096 entry code table over and over
+    randomizer = Random(4)
+    rows = [bytes(randomizer.randrange(256) for x in range(500)) for y in range(200)]
+    palette = [(i, i, i) for i in range(256)]
+    out = io.BytesIO()
+    write_gif(out, 500, 200, [(0, 0, 500, 200, 0, iter(rows))], palette)
+    assert read_gif(out.getvalue())[1] == [rows]
+
+
+def test_avatar_gif_uses_the_palette_colors_of_its_pixels():
+    rows = list(SquareImage.from_rgb_rows(64, read_png(create_avatar(32, 5, format = "png"))[0])._rgb_rows())
+    palette, mapping = gif_palette(color_counts(rows))
+    decoded_palette, frames = read_gif(create_avatar(32, 5, format = "gif"))
+    assert decoded_palette[:len(palette)] == palette
+    assert frames == [list(index_rows(rows, mapping))]
+
+
+def test_animation_frames_are_full_renders():
+    # only the changed rectangles are redrawn, but every frame has to look
+    # like it was drawn from scratch
+    size, hash_val, count = 48, 1234, 4
+    frames = read_png(create_animation(size, hash_val, count))
+    assert len(frames) == count
+    spec = _spec_and_unicorn(size, hash_val)[0]
+    for k, frame in enumerate(frames):
+        parameters = dict(spec.unicorn, pose_phase = (spec.unicorn["pose_phase"] + k / count) % 1)
+        unicorn = _make_unicorn(_fill(UnicornData(), parameters), spec.scale_factor, size)
+        unicorn.project(WorldView(spec.y_angle, spec.x_angle, (150, 0, 0), (0, 100)))
+        assert frame == list(_draw(spec, unicorn, True, "python")._rgb_rows())
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from graphics import backends
+from server import AvatarServer
+
+
+async def _get(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(("GET %s HTTP/1.1\r\nConnection: close\r\n\r\n" % path).encode("ascii"))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    await reader.read()
+    writer.close()
+    return status
+
+
+def test_burst_past_max_waiting_is_turned_away():
+    async def burst():
+        server = AvatarServer(workers = 1, max_inflight = 1, max_waiting = 3)
+        listener = await server.start("127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            statuses = await asyncio.gather(*(_get(port, "/avatar/%x?s=128" % (i + 1)) for i in range(30)))
+        finally:
+            await server.close()
+        return server, statuses
+
+    server, statuses = asyncio.run(burst())
+    assert set(statuses) == {200, 503}
+    assert server.rejected == statuses.count(503)
+    assert server.renders == statuses.count(200)
+    assert server.waiting == 0 and server.inflight == 0
+
+
+def test_zbuffer_without_numpy_fails_right_away(monkeypatch):
+    monkeypatch.delitem(backends, "numpy", raising = False)
+    with pytest.raises(ValueError):
+        AvatarServer(zbuffer = True)
@@ -205,10 +205,15 @@ class UnicornData(Data):
         self.pose_kind = choice(list(pose_functions.keys()))
         self.pose_phase = random()
 
-def gammafunc(gamma):
-    def result(x):
-        return x**gamma
-    return result
+class gammafunc(object):
+    """x -> x**gamma, picklable (see core.reverse)."""
+    __slots__ = ("gamma",)
+
+    def __init__(self, gamma):
+        self.gamma = gamma
+
+    def __call__(self, x):
+        return x**self.gamma
 
 class Unicorn(Figure):
 
@@ -253,16 +258,16 @@ class Unicorn(Figure):
                  NonLinBone(self.brow_right_inner, self.brow_right_middle, xfunc = square),
                  NonLinBone(self.brow_right_middle, self.brow_right_outer, xfunc = math.sqrt),
                 )
+        self.put_on(self.eye_left, self.pupil_left)
+        self.put_on(self.eye_right, self.pupil_right)
 
-        for thing in self.ball_set():
-            thing.rotate(data.face_tilt, self.head, axis = 0)
+        self.rotate(data.face_tilt, self.head, axis = 0)
 
         self.add(Bone(self.head, self.shoulder),
                  self.hairs
                 )
 
-        for thing in self.ball_set():
-            thing.rotate(data.neck_tilt, self.shoulder, axis = 1)
+        self.rotate(data.neck_tilt, self.shoulder, axis = 1)
 
         self.add(Bone(self.shoulder, self.butt),
                  self.tail,